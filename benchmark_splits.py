@@ -0,0 +1,240 @@
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import math
+import random
+import statistics
+import time
+import tracemalloc
+
+import numpy as np
+
+from graph_analysis import (IndexBatches, Roster, build_graph, build_roster,
+                            get_combinations, get_hybrid, hybrid_groups,
+                            lead_count, mask_indices, split_partitions,
+                            validate)
+
+COLUMNS = ['Level', 'Split', 'Generation Time', 'Validated', 'Total',
+           'Validation Time', 'Total Time', 'Expected Pool',
+           'Expected Validation Time', 'Candidates Per Second',
+           'Peak Memory (MB)', 'Trials']
+SAMPLE_BLOCKS = 1024
+
+
+def candidate_source(split, unit_pool, trait_pool, roster, prune):
+    level = sum(split)
+    if split == [1] * level:
+        return get_combinations(level, unit_pool, roster=roster)
+    return get_hybrid(split, unit_pool, trait_pool, roster=roster,
+                      traits=level if prune else 0)
+
+
+def counted(comps, counter):
+    # Pass comps through unchanged while counting the candidates consumed.
+    if isinstance(comps, IndexBatches):
+        def batches():
+            for consumed, rows in comps:
+                counter[0] += consumed
+                yield consumed, rows
+        return IndexBatches(batches())
+
+    def teams():
+        for team in comps:
+            counter[0] += 1
+            yield team
+    return teams()
+
+
+def run_split(split, unit_pool, trait_pool, roster, prune):
+    level = sum(split)
+    counter = [0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.time()
+        comps = candidate_source(split, unit_pool, trait_pool, roster, prune)
+        generated_time = time.time()
+        validated = validate(counted(comps, counter), level, level,
+                             roster=roster, unique=True)
+        end_time = time.time()
+    return (generated_time - start_time, len(validated), counter[0],
+            end_time - generated_time, end_time - start_time)
+
+
+def measure_split(split, unit_pool, trait_pool, roster, prune, warmup,
+                  trials):
+    peak = ''
+    for run in range(warmup):
+        if run == 0:
+            tracemalloc.start()
+        run_split(split, unit_pool, trait_pool, roster, prune)
+        if run == 0:
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+    results = [run_split(split, unit_pool, trait_pool, roster, prune)
+               for _ in range(trials)]
+    generation, validated, total, validation, elapsed = [
+        statistics.median(column) for column in zip(*results)]
+    rate = total / elapsed if elapsed > 0 else ''
+    return {'Generation Time': generation, 'Validated': validated,
+            'Total': total, 'Validation Time': validation,
+            'Total Time': elapsed,
+            'Candidates Per Second': rate, 'Peak Memory (MB)': peak,
+            'Trials': trials}
+
+
+def decomposes(mask, counts, parts):
+    # True when mask splits into disjoint parts, counts[size] of each size.
+    if mask == 0:
+        return True
+    low = mask & -mask
+    rest = mask_indices(mask & ~low)
+    for size in counts:
+        if counts[size] == 0:
+            continue
+        counts[size] -= 1
+        for others in itertools.combinations(rest, size - 1):
+            part = low | sum(1 << unit for unit in others)
+            if part in parts[size] and decomposes(mask & ~part, counts,
+                                                  parts):
+                counts[size] += 1
+                return True
+        counts[size] += 1
+    return False
+
+
+def expected_pool(split, unit_pool, trait_pool, roster, samples, rng):
+    level = sum(split)
+    if split == [1] * level:
+        return math.comb(len(unit_pool), level)
+    groups = hybrid_groups(split, unit_pool, trait_pool, roster)
+    if len(split) == 1:
+        return len(groups[[4, 3, 2, 1].index(split[0])])
+    # Share of random level-unit sets that decompose into the split.
+    parts = {size: set(np.asarray(groups[g]).tolist())
+             for g, size in enumerate([4, 3, 2, 1])}
+    counts = {size: split.count(size) for size in [4, 3, 2, 1]}
+    pool = [roster.unit_index[unit] for unit in unit_pool]
+    hits = 0
+    for _ in range(samples):
+        mask = sum(1 << i for i in rng.sample(pool, level))
+        if decomposes(mask, counts, parts):
+            hits += 1
+    return round(math.comb(len(unit_pool), level) * hits / samples)
+
+
+def sample_split(split, unit_pool, trait_pool, roster, prune, seconds,
+                 pool, rng):
+    # Time a slice of the work and scale it up: combination batches for
+    # all singleton splits, randomly chosen first-slot parts otherwise.
+    level = sum(split)
+    start_time = time.time()
+    if split == [1] * level:
+        with contextlib.redirect_stdout(io.StringIO()):
+            batches = iter(get_combinations(level, unit_pool,
+                                            roster=roster))
+            done = 0
+            for consumed, rows in batches:
+                done += consumed
+                roster.masks(rows[roster.count_active(rows) >= level])
+                if time.time() - start_time > seconds:
+                    break
+        return (time.time() - start_time) * pool / max(done, 1)
+    groups = hybrid_groups(split, unit_pool, trait_pool, roster)
+    leads = lead_count(split, groups)
+    # Blocks of leads, like validate_parallel() shards, so the per-call
+    # setup in hybrid_masks() is not paid once per part.
+    step = max(1, -(-leads // SAMPLE_BLOCKS))
+    blocks = [range(lead, min(lead + step, leads))
+              for lead in range(0, leads, step)]
+    rng.shuffle(blocks)
+    deadline = start_time + seconds
+    done = 0
+    emitted = 0
+    for block in blocks:
+        for mask in roster.hybrid_masks(split, groups, 0,
+                                        level if prune else 0, block,
+                                        deadline):
+            emitted += 1
+        if time.time() > deadline:
+            break
+        done += 1
+    elapsed = time.time() - start_time
+    if prune:
+        # Pruned blocks emit only passing sets, so scale by whole blocks;
+        # when none finishes in time this is a lower bound.
+        return elapsed * len(blocks) / max(done, 1)
+    # Unpruned runs emit every unit set of the expected pool, and a single
+    # block can take hours at high levels, so scale by sets emitted.
+    return elapsed * pool / max(emitted, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark every split of levels 1..N and write the '
+                    'results in the split_analysis.csv layout.')
+    parser.add_argument('--levels', type=int, default=9)
+    parser.add_argument('--exact-level', type=int, default=5,
+                        help='levels above this are estimated from samples')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--trials', type=int, default=3)
+    parser.add_argument('--sample-seconds', type=float, default=2.0)
+    parser.add_argument('--pool-samples', type=int, default=2000)
+    parser.add_argument('--prune', action='store_true',
+                        help='cut hybrid unit sets that cannot reach the '
+                             'trait threshold; Total then only counts the '
+                             'sets that do')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='split_analysis.csv')
+    args = parser.parse_args()
+
+    unit_pool, trait_pool = build_roster()
+    build_graph(unit_pool)
+    roster = Roster(unit_pool, trait_pool)
+    prune = args.prune
+    rng = random.Random(args.seed)
+
+    rows = []
+    for level in range(1, args.levels + 1):
+        for split in split_partitions(level):
+            row = {'Level': level, 'Split': str(split)}
+            if level <= args.exact_level:
+                row.update(measure_split(split, unit_pool, trait_pool,
+                                         roster, prune, args.warmup,
+                                         args.trials))
+                # Unpruned runs see the whole pool; pruned ones only the
+                # candidates that could still reach the threshold.
+                row['Expected Pool'] = row['Total']
+                if prune:
+                    row['Expected Pool'] = expected_pool(
+                        split, unit_pool, trait_pool, roster,
+                        args.pool_samples, rng)
+                print('Level ' + str(level) + ' ' + str(split) + ': ' +
+                      str(row['Validated']) + ' of ' + str(row['Total']) +
+                      ' in ' + str(row['Total Time']) + ' seconds')
+            else:
+                row['Expected Pool'] = expected_pool(
+                    split, unit_pool, trait_pool, roster, args.pool_samples,
+                    rng)
+                row['Expected Validation Time'] = sample_split(
+                    split, unit_pool, trait_pool, roster, prune,
+                    args.sample_seconds, row['Expected Pool'], rng)
+                if split == [1] * level:
+                    # Plain combinations validate every valid comp, which
+                    # count_valid() can count without enumerating them.
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        row['Validated'] = roster.count_valid(level, level)
+                print('Level ' + str(level) + ' ' + str(split) +
+                      ': expected ' + str(row['Expected Pool']) +
+                      ' candidates in ' +
+                      str(row['Expected Validation Time']) + ' seconds')
+            rows.append(row)
+
+    with open(args.output, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
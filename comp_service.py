@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import io
+import json
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from graph_analysis import Roster, build_graph, build_roster, mask_rows
+
+CACHE_SIZE = 256
+
+
+class CompIndex:
+    def __init__(self, roster, level, traits):
+        # Every comp of level units with at least traits active, ranked by
+        # score and then mask, with a posting list of comp ids per unit.
+        self.level = level
+        self.traits = traits
+        masks = np.concatenate(list(roster.join_masks(level, traits)) +
+                               [np.zeros(0, dtype=np.uint64)])
+        rows = mask_rows(masks, level)
+        scores = roster.score(rows)
+        ranking = np.lexsort((masks, -scores))
+        self.masks = masks[ranking]
+        self.scores = scores[ranking]
+        self.active = roster.count_active(rows[ranking])
+        self.postings = [np.flatnonzero(self.masks >> np.uint64(i) &
+                                        np.uint64(1))
+                         for i in range(len(roster.units))]
+
+    def get_level(self):
+        return self.level
+
+    def get_traits(self):
+        return self.traits
+
+    def __len__(self):
+        return len(self.masks)
+
+    def query(self, forced, traits):
+        # Intersect the posting lists shortest first; ids stay in rank order.
+        ids = None
+        for postings in sorted((self.postings[i] for i in forced), key=len):
+            ids = postings if ids is None else \
+                np.intersect1d(ids, postings, assume_unique=True)
+        if ids is None:
+            ids = np.arange(len(self.masks))
+        ids = ids[self.active[ids] >= traits]
+        return self.scores[ids].tolist(), self.masks[ids].tolist()
+
+
+class QueryCache:
+    def __init__(self, capacity=CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, k):
+        # An entry answers any k up to the number of comps it was built with,
+        # or every k when it holds the complete ranking.
+        entry = self.entries.get(key)
+        if entry is None or (not entry[2] and k > len(entry[0])):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0][:k], entry[1][:k]
+
+    def narrow(self, key):
+        # A complete ranking for fewer forced units holds every answer for
+        # more of them, in order, so it only needs filtering.
+        level, traits, forced = key
+        wanted = sum(1 << i for i in forced)
+        for (other_level, other_traits, other_forced), entry in \
+                reversed(self.entries.items()):
+            if other_level == level and other_traits == traits and \
+                    entry[2] and set(other_forced) <= set(forced):
+                self.hits += 1
+                kept = [i for i, mask in enumerate(entry[1])
+                        if mask & wanted == wanted]
+                return [entry[0][i] for i in kept], \
+                    [entry[1][i] for i in kept]
+        return None
+
+    def put(self, key, scores, masks, complete):
+        self.entries[key] = (scores, masks, complete)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class CompService:
+    def __init__(self, unit_pool, trait_pool, levels, slack=1,
+                 cache_size=CACHE_SIZE):
+        start_time = time.time()
+        build_graph(unit_pool)
+        self.roster = Roster(unit_pool, trait_pool)
+        self.names = {unit.get_name(): unit for unit in unit_pool}
+        self.indexes = {}
+        for level in levels:
+            self.indexes[level] = CompIndex(self.roster, level,
+                                            max(0, level - slack))
+        self.cache = QueryCache(cache_size)
+        self.load_time = time.time() - start_time
+
+    def status(self):
+        return {'units': len(self.roster.units),
+                'indexes': {str(level): {'traits': index.get_traits(),
+                                         'comps': len(index)}
+                            for level, index in self.indexes.items()},
+                'cached': len(self.cache), 'hits': self.cache.hits,
+                'misses': self.cache.misses,
+                'load_seconds': self.load_time}
+
+    def query(self, level, traits, force, k):
+        start_time = time.time()
+        unknown = [name for name in force if name not in self.names]
+        if unknown:
+            raise ValueError('Unknown units: ' + ', '.join(unknown))
+        if k < 1 or level < len(set(force)):
+            raise ValueError('Need k >= 1 and level >= forced units.')
+        forced = sorted(set(self.roster.unit_index[self.names[name]]
+                            for name in force))
+        key = (level, traits, tuple(forced))
+        source = 'cache'
+        found = self.cache.get(key, k)
+        if found is None:
+            index = self.indexes.get(level)
+            narrowed = self.cache.narrow(key)
+            if narrowed is not None:
+                scores, masks = narrowed
+                self.cache.put(key, scores, masks, True)
+            elif index is not None and traits >= index.get_traits():
+                source = 'index'
+                scores, masks = index.query(forced, traits)
+                self.cache.put(key, scores, masks, True)
+            else:
+                source = 'search'
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ranked = self.roster.top_k(
+                        level, k, traits,
+                        [self.roster.units[i] for i in forced])
+                scores = [score for score, team in ranked]
+                masks = [self.roster.encode(team) for score, team in ranked]
+                self.cache.put(key, scores, masks, len(ranked) < k)
+            found = scores[:k], masks[:k]
+        comps = [{'units': sorted(unit.get_name()
+                                  for unit in self.roster.decode(mask)),
+                  'score': score} for score, mask in zip(*found)]
+        return {'level': level, 'traits': traits, 'force': sorted(force),
+                'k': k, 'source': source, 'comps': comps,
+                'milliseconds': (time.time() - start_time) * 1000}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        try:
+            if url.path == '/status':
+                body = self.service.status()
+            elif url.path == '/comps':
+                level = int(params['level'][0])
+                force = [name for value in params.get('force', [])
+                         for name in value.split(',') if name]
+                body = self.service.query(
+                    level, int(params.get('traits', [level])[0]), force,
+                    int(params.get('k', [10])[0]))
+            else:
+                self.reply(404, {'error': 'Unknown path ' + url.path})
+                return
+        except (KeyError, ValueError) as error:
+            self.reply(400, {'error': str(error)})
+            return
+        self.reply(200, body)
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve best comps containing forced units over localhost '
+                    'HTTP, e.g. GET /comps?level=8&traits=7&force=viego,'
+                    'annie&k=10')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--index-levels', type=int, default=6,
+                        help='precompute every comp of levels 1..N')
+    parser.add_argument('--slack', type=int, default=1,
+                        help='indexed comps have at least level - slack '
+                             'traits; lower thresholds use search')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE)
+    args = parser.parse_args()
+
+    unit_pool, trait_pool = build_roster()
+    QueryHandler.service = CompService(unit_pool, trait_pool,
+                                       range(1, args.index_levels + 1),
+                                       args.slack, args.cache_size)
+    print('Loaded roster and indexes in ' +
+          str(QueryHandler.service.load_time) + ' seconds, serving on ' +
+          args.host + ':' + str(args.port))
+    HTTPServer((args.host, args.port), QueryHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,52 @@
+from concurrent.futures import ProcessPoolExecutor
+import atexit
 import itertools
-from collections import Counter
+from collections import Counter, deque
+from functools import lru_cache
+import hashlib
+import heapq
+import json
+import math
+import os
+import queue
+import random
+import threading
 import time
 
+import numpy as np
+
+from roster_loader import SET_PATH, build_pools, load_definition
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BATCH_SIZE = 100000
+TRAITS_PER_LANE = 12
+TAIL_WIDTH = 2
+SHARDS_PER_WORKER = 8
+CHUNK_SIZE = 4000000
+CHECKPOINT_SECONDS = 30
+PLAN_SECONDS = 0.2
+PIPELINE_DEPTH = 4
+STAGE_COUNTS = ['generated', 'overlapping', 'duplicate', 'few_traits',
+                'accepted']
+TRACER = None
+STORE_COLUMNS = ['masks', 'active', 'tiers', 'costs', 'levels']
+STORE_DTYPES = {'masks': '<u8', 'active': '<u8', 'tiers': '|u1',
+                'costs': '<u2', 'levels': '|u1', 'unit_index': '|u1',
+                'trait_index': '|u1'}
+BRANCH_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '.branch_cache')
+ROSTER_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '.roster_cache')
+SNAPSHOT_VERSION = 1
+
 
 class Node:
+    __slots__ = ['name', 'traits', 'cost', 'neighbors', 'id']
+
     def __init__(self, name, traits, cost):
         self.name = name
         self.traits = traits
@@ -11,13 +54,7 @@ class Node:
             trait.add_unit(self)
         self.cost = cost
         self.neighbors = []
-        self.visited = False
-
-    def visit(self):
-        self.visited = True
-
-    def unvisit(self):
-        self.visited = False
+        self.id = None
 
     def get_traits(self):
         return self.traits
@@ -28,19 +65,26 @@ class Node:
     def get_cost(self):
         return self.cost
 
+    def get_id(self):
+        return self.id
+
     def get_neighbors(self):
         return self.neighbors
 
     def set_neighbors(self):
+        # Units sharing several traits are still a single neighbor.
         self.neighbors = []
+        seen = set([self])
         for trait in self.traits:
-            local = trait.get_units()
-            for unit in local:
-                if unit != self:
+            for unit in trait.get_units():
+                if unit not in seen:
+                    seen.add(unit)
                     self.neighbors.append(unit)
 
 
 class Trait:
+    __slots__ = ['name', 'tiers', 'min', 'units']
+
     def __init__(self, name, tiers):
         self.name = name
         self.tiers = tiers
@@ -60,9 +104,1498 @@ class Trait:
         return self.units
 
 
+class Graph:
+    def __init__(self, unit_pool):
+        # Compiled view of the unit graph keyed by Node.id: a boolean
+        # adjacency matrix plus neighbor and trait membership bitmasks.
+        self.units = list(unit_pool)
+        self.traits = []
+        for unit in self.units:
+            for trait in unit.get_traits():
+                if trait not in self.traits:
+                    self.traits.append(trait)
+        self.adjacency = np.zeros((len(self.units), len(self.units)),
+                                  dtype=bool)
+        self.neighbor_masks = [0] * len(self.units)
+        for unit in self.units:
+            for neighbor in unit.get_neighbors():
+                if neighbor.get_id() is not None:
+                    self.adjacency[unit.get_id(), neighbor.get_id()] = True
+                    self.neighbor_masks[unit.get_id()] |= \
+                        1 << neighbor.get_id()
+        self.trait_masks = {trait: sum(1 << unit.get_id()
+                                       for unit in trait.get_units()
+                                       if unit.get_id() is not None)
+                            for trait in self.traits}
+
+    def get_units(self):
+        return self.units
+
+    def get_traits(self):
+        return self.traits
+
+    def get_adjacency(self):
+        return self.adjacency
+
+    def get_neighbor_mask(self, unit):
+        return self.neighbor_masks[unit.get_id()]
+
+    def get_trait_mask(self, trait):
+        return self.trait_masks.get(trait, 0)
+
+    def are_neighbors(self, first, second):
+        return bool(self.neighbor_masks[first.get_id()] >>
+                    second.get_id() & 1)
+
+    def relink(self, units):
+        # Rebuild only the given units' neighbor lists and their rows and
+        # columns in the adjacency, keeping the rest of the graph as is.
+        for unit in units:
+            unit.set_neighbors()
+        for unit in units:
+            i = unit.get_id()
+            self.adjacency[i, :] = False
+            self.adjacency[:, i] = False
+            for neighbor in unit.get_neighbors():
+                if neighbor.get_id() is not None:
+                    self.adjacency[i, neighbor.get_id()] = True
+                    self.adjacency[neighbor.get_id(), i] = True
+        for unit in units:
+            for j in [unit.get_id()] + np.flatnonzero(
+                    self.adjacency[unit.get_id()]).tolist():
+                row = np.flatnonzero(self.adjacency[j]).tolist()
+                self.neighbor_masks[j] = sum(1 << k for k in row)
+        for trait in set(trait for unit in units
+                         for trait in unit.get_traits()):
+            if trait not in self.trait_masks:
+                self.traits.append(trait)
+            self.trait_masks[trait] = sum(1 << member.get_id()
+                                          for member in trait.get_units()
+                                          if member.get_id() is not None)
+
+    def add_emblem(self, unit, trait):
+        unit.traits.append(trait)
+        trait.add_unit(unit)
+        self.relink([unit] + [member for member in trait.get_units()
+                              if member is not unit])
+
+    def remove_emblem(self, unit, trait):
+        members = [member for member in trait.get_units()
+                   if member is not unit]
+        unit.traits.remove(trait)
+        trait.units.remove(unit)
+        self.relink([unit] + members)
+        self.trait_masks[trait] &= ~(1 << unit.get_id())
+
+
+class IndexBatches:
+    def __init__(self, batches):
+        self.batches = batches
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+class SeenMasks:
+    def __init__(self):
+        # Batches are kept as sorted uint64 runs, 8 bytes per comp where a
+        # set of sorted (cost, name) tuples costs a few hundred. New runs
+        # are merged into the one before until each run is under half the
+        # size of the previous one, so a lookup searches O(log n) runs.
+        # Comps checked one at a time go to a plain set of int masks.
+        self.runs = []
+        self.single = set()
+
+    def __len__(self):
+        return len(self.single) + sum(len(run) for run in self.runs)
+
+    def add(self, mask):
+        if mask in self.single:
+            return False
+        self.single.add(mask)
+        return True
+
+    def add_new(self, masks):
+        masks = np.asarray(masks, dtype=np.uint64)
+        first = np.argsort(masks, kind='stable')
+        masks = masks[first]
+        fresh = np.ones(len(masks), dtype=bool)
+        fresh[1:] = masks[1:] != masks[:-1]
+        for run in self.runs:
+            positions = np.searchsorted(run, masks)
+            known = positions < len(run)
+            fresh[known] &= run[positions[known]] != masks[known]
+        masks, first = masks[fresh], first[fresh]
+        if len(masks) > 0:
+            self.runs.append(masks)
+            while len(self.runs) > 1 and \
+                    len(self.runs[-2]) < 2 * len(self.runs[-1]):
+                merged = np.concatenate([self.runs.pop(-2),
+                                         self.runs.pop()])
+                merged.sort()
+                self.runs.append(merged)
+        # Hand the new masks back in the order they first arrived.
+        return masks[np.argsort(first)]
+
+
+class CompWriter:
+    def __init__(self, path, buffer_size=BATCH_SIZE):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.lines = []
+        self.written = 0
+        self.file = open(path, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_written(self):
+        return self.written
+
+    def write(self, comp):
+        self.lines.append(','.join(sorted(unit.name for unit in comp)) +
+                          '\n')
+        self.written += 1
+        if len(self.lines) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.file.writelines(self.lines)
+        self.lines = []
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+class CompStoreWriter:
+    def __init__(self, path, roster, buffer_size=BATCH_SIZE):
+        # Appends comps to raw little-endian column files in path; close()
+        # adds the bitmap indexes and the meta.json CompStore opens them by.
+        if len(roster.traits) > 64:
+            raise ValueError('Active trait bitmasks hold at most 64 traits.')
+        self.path = path
+        self.roster = roster
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.written = 0
+        self.trait_bits = np.left_shift(
+            np.uint64(1), np.arange(len(roster.traits), dtype=np.uint64))
+        os.makedirs(path, exist_ok=True)
+        self.files = {name: open(os.path.join(path, name + '.bin'), 'wb')
+                      for name in STORE_COLUMNS}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_written(self):
+        return self.written
+
+    def write(self, comp):
+        self.buffer.append(self.roster.encode(comp))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_masks(self, masks):
+        self.flush()
+        masks = np.asarray(masks, dtype=np.uint64)
+        for start in range(0, len(masks), self.buffer_size):
+            self.append(masks[start:start + self.buffer_size])
+
+    def flush(self):
+        if self.buffer:
+            self.append(np.array(self.buffer, dtype=np.uint64))
+            self.buffer = []
+
+    def append(self, masks):
+        roster = self.roster
+        levels = np.bitwise_count(masks)
+        active = np.zeros(len(masks), dtype=np.uint64)
+        tiers = np.zeros((len(masks), len(roster.traits)), dtype=np.uint8)
+        costs = np.zeros(len(masks), dtype=np.uint16)
+        for level in np.unique(levels).tolist():
+            if level == 0:
+                continue
+            picked = levels == level
+            rows = mask_rows(masks[picked], level)
+            counts = roster.trait_counts(rows)
+            tiers[picked] = roster.tier_table[np.arange(len(roster.traits)),
+                                              counts]
+            active[picked] = np.bitwise_or.reduce(
+                np.where(counts >= roster.mins, self.trait_bits,
+                         np.uint64(0)), axis=1, initial=np.uint64(0))
+            costs[picked] = roster.costs[rows].sum(axis=1)
+        columns = {'masks': masks, 'active': active, 'tiers': tiers,
+                   'costs': costs, 'levels': levels}
+        for name in STORE_COLUMNS:
+            self.files[name].write(
+                columns[name].astype(STORE_DTYPES[name]).tobytes())
+        self.written += len(masks)
+
+    def close(self):
+        if self.files['masks'].closed:
+            return
+        self.flush()
+        for file in self.files.values():
+            file.close()
+        # Row r is bit r of every index row, packed 8 rows a byte in the
+        # same order as np.packbits; batch_size is a multiple of 8.
+        size = -(-self.written // 8)
+        batch_size = self.buffer_size - self.buffer_size % 8 or 8
+        for name, source, width in [('unit_index', 'masks',
+                                     len(self.roster.units)),
+                                    ('trait_index', 'active',
+                                     len(self.roster.traits))]:
+            column = store_column(self.path, source, (self.written,))
+            index = np.zeros((width, size), dtype=STORE_DTYPES[name])
+            shifts = np.arange(width, dtype=np.uint64)
+            for start in range(0, self.written, batch_size):
+                bits = column[start:start + batch_size, None] >> shifts & \
+                    np.uint64(1)
+                index[:, start // 8:-(-(start + len(bits)) // 8)] = \
+                    np.packbits(bits.T.astype(bool), axis=1)
+            index.tofile(os.path.join(self.path, name + '.bin'))
+        meta = {'count': self.written,
+                'fingerprint': self.roster.fingerprint(),
+                'units': [[unit.name, unit.cost]
+                          for unit in self.roster.units],
+                'traits': [trait.name for trait in self.roster.traits]}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+
+
+class CompStore:
+    def __init__(self, path):
+        # Every column is a read-only memmap, so processes opening the same
+        # store share its pages through the OS page cache.
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+        self.count = meta['count']
+        self.fingerprint = meta['fingerprint']
+        self.units = [name for name, cost in meta['units']]
+        self.unit_costs = {name: cost for name, cost in meta['units']}
+        self.traits = meta['traits']
+        shapes = {'masks': (self.count,), 'active': (self.count,),
+                  'tiers': (self.count, len(self.traits)),
+                  'costs': (self.count,), 'levels': (self.count,),
+                  'unit_index': (len(self.units), -(-self.count // 8)),
+                  'trait_index': (len(self.traits), -(-self.count // 8))}
+        for name, shape in shapes.items():
+            setattr(self, name, store_column(path, name, shape))
+
+    def __len__(self):
+        return self.count
+
+    def get_units(self):
+        return self.units
+
+    def get_traits(self):
+        return self.traits
+
+    def get_masks(self):
+        return self.masks
+
+    def get_active(self):
+        return self.active
+
+    def get_tiers(self):
+        return self.tiers
+
+    def get_costs(self):
+        return self.costs
+
+    def get_levels(self):
+        return self.levels
+
+    def select(self, units=[], without_units=[], active=[], inactive=[],
+               without_costs=[], min_cost=None, max_cost=None, levels=None,
+               min_tiers={}):
+        # Unit and trait conditions are ANDed over the packed bitmap indexes,
+        # so only the surviving rows touch the numeric columns.
+        unit_ids = {name: i for i, name in enumerate(self.units)}
+        trait_ids = {name: j for j, name in enumerate(self.traits)}
+        unknown = [name for name in list(units) + list(without_units)
+                   if name not in unit_ids] + \
+            [name for name in list(active) + list(inactive) + list(min_tiers)
+             if name not in trait_ids]
+        if unknown:
+            raise ValueError('Unknown units or traits: ' + ', '.join(unknown))
+        without_units = set(without_units) | set(
+            name for name in self.units
+            if self.unit_costs[name] in without_costs)
+        keep = np.full(-(-self.count // 8), 255, dtype=np.uint8)
+        for name in units:
+            keep &= self.unit_index[unit_ids[name]]
+        for name in without_units:
+            keep &= ~self.unit_index[unit_ids[name]]
+        for name in active:
+            keep &= self.trait_index[trait_ids[name]]
+        for name in inactive:
+            keep &= ~self.trait_index[trait_ids[name]]
+        rows = np.flatnonzero(np.unpackbits(keep, count=self.count))
+        if min_cost is not None:
+            rows = rows[self.costs[rows] >= min_cost]
+        if max_cost is not None:
+            rows = rows[self.costs[rows] <= max_cost]
+        if levels is not None:
+            rows = rows[np.isin(self.levels[rows], list(levels))]
+        for name, tier in min_tiers.items():
+            rows = rows[self.tiers[rows, trait_ids[name]] >= tier]
+        return rows
+
+    def decode(self, rows):
+        return [[name for i, name in enumerate(self.units) if mask >> i & 1]
+                for mask in self.masks[rows].tolist()]
+
+
+class CostLimits:
+    def __init__(self, budget=None, caps={}, allowed=None):
+        # budget bounds a comp's total gold, caps[c] its number of c-cost
+        # units and allowed, when given, the unit costs it may use at all.
+        self.budget = budget
+        self.caps = dict(caps)
+        self.allowed = None if allowed is None else set(allowed)
+
+    def get_budget(self):
+        return self.budget
+
+    def get_caps(self):
+        return self.caps
+
+    def get_allowed(self):
+        return self.allowed
+
+    def allows(self, cost):
+        return (self.allowed is None or cost in self.allowed) and \
+            self.caps.get(cost, 1) > 0
+
+    def check_counts(self, spent, used):
+        return (self.budget is None or spent <= self.budget) and \
+            all(used[cost] <= cap for cost, cap in self.caps.items())
+
+    def check(self, rows, costs):
+        # Which index rows meet every limit, given the roster's unit costs.
+        spent = costs[rows]
+        keep = np.ones(len(rows), dtype=bool)
+        if self.budget is not None:
+            keep &= spent.sum(axis=1) <= self.budget
+        for cost, cap in self.caps.items():
+            keep &= (spent == cost).sum(axis=1) <= cap
+        if self.allowed is not None:
+            keep &= np.isin(spent, list(self.allowed)).all(axis=1)
+        return keep
+
+
+class Roster:
+    def __init__(self, unit_pool, trait_pool=[]):
+        self.units = list(unit_pool)
+        if len(self.units) > 64:
+            raise ValueError('Rosters of more than 64 units do not fit a '
+                             'uint64 bitmask.')
+        self.traits = list(trait_pool)
+        for unit in self.units:
+            for trait in unit.get_traits():
+                if trait not in self.traits:
+                    self.traits.append(trait)
+        self.unit_index = {unit: i for i, unit in enumerate(self.units)}
+        trait_index = {trait: i for i, trait in enumerate(self.traits)}
+        self.matrix = np.zeros((len(self.units), len(self.traits)),
+                               dtype=np.int8)
+        for i, unit in enumerate(self.units):
+            for trait in unit.get_traits():
+                self.matrix[i, trait_index[trait]] += 1
+        self.mins = np.array([trait.get_min() for trait in self.traits],
+                             dtype=np.int8)
+        self.bits = np.left_shift(np.uint64(1),
+                                  np.arange(len(self.units), dtype=np.uint64))
+        self.costs = np.array([unit.get_cost() for unit in self.units],
+                              dtype=np.intp)
+        # tier_table[j][c]: tiers of trait j reached with c copies.
+        copies = int(self.matrix.sum(axis=0).max(initial=0))
+        self.tier_table = np.array([[sum(1 for tier in trait.tiers
+                                         if tier <= c)
+                                     for c in range(copies + 1)]
+                                    for trait in self.traits],
+                                   dtype=np.intp).reshape(len(self.traits),
+                                                          copies + 1)
+        self.pack_traits()
+
+    def __getstate__(self):
+        # Pool workers only score index rows, so the Node and Trait objects
+        # (and the graph hanging off them) stay in the parent process.
+        state = self.__dict__.copy()
+        for name in ['units', 'traits', 'unit_index']:
+            state.pop(name)
+        return state
+
+    def pack_traits(self):
+        # Each trait gets a 5 bit field in one of several uint64 lanes, so a
+        # comp's trait counts are a plain sum of its unit rows and a trait is
+        # active when adding (16 - min) carries into the field's top bit.
+        lanes = -(-len(self.traits) // TRAITS_PER_LANE)
+        self.packed = np.zeros((len(self.units), lanes), dtype=np.uint64)
+        self.bias = np.zeros(lanes, dtype=np.uint64)
+        self.carry = np.zeros(lanes, dtype=np.uint64)
+        self.max_level = 0
+        if len(self.traits) == 0 or self.mins.max() > 15 or \
+                self.mins.min() < 1:
+            return
+        self.max_level = 15 // max(1, int(self.matrix.max()))
+        for j in range(len(self.traits)):
+            lane, shift = divmod(j, TRAITS_PER_LANE)
+            shift *= 5
+            self.packed[:, lane] += (self.matrix[:, j].astype(np.uint64) <<
+                                     np.uint64(shift))
+            self.bias[lane] += np.uint64(16 - int(self.mins[j]) << shift)
+            self.carry[lane] += np.uint64(16 << shift)
+
+    def get_units(self):
+        return self.units
+
+    def get_traits(self):
+        return self.traits
+
+    def fingerprint(self):
+        definition = repr([(unit.name, unit.cost,
+                            [trait.name for trait in unit.get_traits()])
+                           for unit in self.units] +
+                          [(trait.name, trait.tiers) for trait in self.traits])
+        return hashlib.sha1(definition.encode()).hexdigest()
+
+    def encode(self, team):
+        mask = 0
+        for unit in team:
+            mask |= 1 << self.unit_index[unit]
+        return mask
+
+    def decode(self, mask):
+        return set(unit for i, unit in enumerate(self.units)
+                   if mask >> i & 1)
+
+    def trait_counts(self, rows):
+        counts = self.matrix[rows[:, 0]].copy()
+        for column in range(1, rows.shape[1]):
+            counts += self.matrix[rows[:, column]]
+        return counts
+
+    def count_active(self, rows):
+        if rows.shape[1] == 0:
+            return np.zeros(len(rows), dtype=np.intp)
+        if rows.shape[1] > self.max_level:
+            return (self.trait_counts(rows) >= self.mins).sum(axis=1)
+        active = np.zeros(len(rows), dtype=np.uint8)
+        for lane in range(self.packed.shape[1]):
+            column = self.packed[:, lane]
+            counts = column[rows[:, 0]]
+            for position in range(1, rows.shape[1]):
+                counts += column[rows[:, position]]
+            counts += self.bias[lane]
+            counts &= self.carry[lane]
+            active += np.bitwise_count(counts)
+        return active
+
+    def masks(self, rows):
+        return np.bitwise_or.reduce(self.bits[rows], axis=1)
+
+    def trait_weights(self, weights=None):
+        if weights is None:
+            weights = {}
+        return np.array([weights.get(trait, 1) for trait in self.traits],
+                        dtype=np.float64)
+
+    def score(self, rows, weights=None, cost_weight=0):
+        # Weighted tiers reached per trait, plus cost_weight per gold spent.
+        if len(rows) == 0 or rows.shape[1] == 0:
+            return np.zeros(len(rows), dtype=np.float64)
+        tiers = self.tier_table[np.arange(len(self.traits)),
+                                self.trait_counts(rows)]
+        scores = tiers @ self.trait_weights(weights)
+        if cost_weight:
+            scores += cost_weight * self.costs[rows].sum(axis=1)
+        return scores
+
+    def combinations(self, level, unit_pool=None, force=[],
+                     batch_size=BATCH_SIZE):
+        if unit_pool is None:
+            unit_pool = self.units
+        forced = [self.unit_index[unit] for unit in force]
+        pool = np.array([self.unit_index[unit] for unit in unit_pool
+                         if self.unit_index[unit] not in forced],
+                        dtype=np.intp)
+        forced = np.array(forced, dtype=np.intp)
+
+        def batches():
+            if len(forced) > level:
+                return
+            for rows in index_combinations(len(pool), level - len(forced),
+                                           batch_size):
+                rows = pool[rows]
+                if len(forced) > 0:
+                    rows = np.hstack([rows, np.broadcast_to(
+                        forced, (len(rows), len(forced)))])
+                yield len(rows), rows
+
+        return IndexBatches(batches())
+
+    def classes(self, units=None, by_cost=False):
+        # With by_cost, units only share a class when their costs match too.
+        if units is None:
+            units = range(len(self.units))
+        signatures = {}
+        for i in units:
+            signature = self.matrix[i].tobytes()
+            if by_cost:
+                signature += bytes(str(int(self.costs[i])), 'ascii')
+            signatures.setdefault(signature, []).append(i)
+        return list(signatures.values())
+
+    def cost_bounds(self, order, level, limits):
+        # cheapest[p][s]: least gold any s units of order[p:] cost, which
+        # never falls as p grows, so a loop over p can stop at the first
+        # position the remaining budget cannot fill.
+        costs = [int(self.costs[i]) for i in order]
+        cheapest = []
+        for p in range(len(order) + 1):
+            sizes = sorted(costs[p:])[:level]
+            cheapest.append([0] + list(itertools.accumulate(sizes)) +
+                            [math.inf] * (level - len(sizes)))
+        budget = limits.get_budget()
+        caps = dict.fromkeys(set(costs), level)
+        caps.update(limits.get_caps())
+        return cheapest, math.inf if budget is None else budget, caps
+
+    def expand(self, mask, classes):
+        # A class multiset stands for every way of picking the same number
+        # of units from each class; units outside the classes are kept.
+        choices = []
+        for members in classes:
+            chosen = 0
+            for i in members:
+                if mask >> i & 1:
+                    chosen += 1
+                    mask &= ~(1 << i)
+            if chosen > 0:
+                choices.append(itertools.combinations(members, chosen))
+        for picks in itertools.product(*choices):
+            yield mask | sum(1 << i for pick in picks for i in pick)
+
+    def search(self, level, min_traits, force=[], symmetry=True,
+               limits=None):
+        start_time = time.time()
+
+        forced = [self.unit_index[unit] for unit in force]
+        allowed = set(i for i in range(len(self.units))
+                      if limits is None or
+                      limits.allows(self.units[i].get_cost()))
+        allowed.update(forced)
+        # Search units carrying the most traits first, grouped by their most
+        # common trait, so the trait copies reachable behind each position
+        # shrink quickly and the bound prunes whole subtrees early.
+        frequency = self.matrix.sum(axis=0)
+        rank = np.argsort(np.argsort(-frequency, kind='stable'),
+                          kind='stable')
+        order = sorted((i for i in allowed if i not in forced),
+                       key=lambda i: (-int(self.matrix[i].sum()), sorted(
+                           rank[np.flatnonzero(self.matrix[i])].tolist()),
+                           self.matrix[i].tolist(), int(self.costs[i]), i))
+        # Units with identical trait rows are interchangeable, so with
+        # symmetry on only class multisets are searched: a unit may join
+        # only after the class member just before it in the order. Members
+        # are ordered cheapest first, so a searched multiset is the cheapest
+        # comp it stands for; per-cost caps need same-cost classes though.
+        by_cost = limits is not None and len(limits.get_caps()) > 0
+        classes = [members for members in self.classes(order, by_cost)
+                   if len(members) > 1]
+        shared = sum(1 << i for members in classes for i in members)
+        predecessor = {i: None for i in order}
+        if symmetry:
+            for p in range(1, len(order)):
+                if (self.matrix[order[p]] == self.matrix[order[p - 1]]).all() \
+                        and (not by_cost or self.costs[order[p]] ==
+                             self.costs[order[p - 1]]):
+                    predecessor[order[p]] = order[p - 1]
+        unit_traits = [[(j, int(self.matrix[i, j]))
+                        for j in np.flatnonzero(self.matrix[i])]
+                       for i in range(len(self.units))]
+        mins = self.mins.tolist()
+        multiplicity = self.matrix.max(axis=0).tolist()
+        # available[p][j]: copies of trait j among order[p:], so the bound
+        # only counts traits the remaining canonical extensions can reach.
+        available = np.zeros((len(order) + 1, len(self.traits)),
+                             dtype=np.intp)
+        for p in range(len(order) - 1, -1, -1):
+            available[p] = available[p + 1] + self.matrix[order[p]]
+        available = available.tolist()
+        # supply[p][s]: most trait copies any s units from order[p:] carry.
+        supply = []
+        for p in range(len(order) + 1):
+            sizes = sorted((int(self.matrix[i].sum()) for i in order[p:]),
+                           reverse=True)
+            supply.append([0] + list(itertools.accumulate(sizes[:level])))
+        # The last TAIL_WIDTH slots are scored as one NumPy batch over every
+        # remaining combination instead of being descended into.
+        tail_width = min(TAIL_WIDTH, level - len(forced))
+        if level > self.max_level:
+            tail_width = 0
+        if tail_width > 0:
+            tail = combination_table(len(order), tail_width)
+            tail_starts = np.searchsorted(tail[:, 0],
+                                          np.arange(len(order) + 1))
+            tail_rows = np.array(order, dtype=np.intp)[tail]
+            tail_packed = self.packed[tail_rows].sum(axis=1, dtype=np.uint64)
+            tail_masks = self.masks(tail_rows)
+            # Class predecessors a tail row relies on outside of itself.
+            tail_needs = np.zeros(len(tail), dtype=np.uint64)
+            for column in range(tail_width):
+                needs = np.array([0 if predecessor[i] is None else
+                                  1 << predecessor[i]
+                                  for i in tail_rows[:, column]],
+                                 dtype=np.uint64)
+                tail_needs |= needs
+            tail_needs &= ~tail_masks
+        limited = limits is not None
+        if limited:
+            cheapest, budget, caps = self.cost_bounds(order, level, limits)
+            unit_costs = self.costs.tolist()
+            used = Counter()
+            if tail_width > 0:
+                tail_costs = self.costs[tail_rows]
+                tail_spent = tail_costs.sum(axis=1)
+                tail_used = {cost: (tail_costs == cost).sum(axis=1)
+                             for cost in limits.get_caps()}
+        bases = [self.bias.copy()]
+        counts = [0] * len(self.traits)
+        state = {'active': 0, 'mask': 0, 'visited': 0, 'spent': 0}
+        results = []
+
+        def push(i):
+            bases.append(bases[-1] + self.packed[i])
+            state['mask'] |= 1 << i
+            if limited:
+                state['spent'] += unit_costs[i]
+                used[unit_costs[i]] += 1
+            for j, amount in unit_traits[i]:
+                before = counts[j]
+                counts[j] += amount
+                if before < mins[j] <= counts[j]:
+                    state['active'] += 1
+
+        def pop(i):
+            bases.pop()
+            state['mask'] &= ~(1 << i)
+            if limited:
+                state['spent'] -= unit_costs[i]
+                used[unit_costs[i]] -= 1
+            for j, amount in unit_traits[i]:
+                before = counts[j]
+                counts[j] -= amount
+                if counts[j] < mins[j] <= before:
+                    state['active'] -= 1
+
+        def potential(position, slots):
+            return state['active'] + reachable_traits(
+                counts, mins, available[position], multiplicity, slots,
+                supply[position][min(slots, len(order) - position)])
+
+        def descend(position, slots):
+            state['visited'] += 1
+            if slots == tail_width > 0:
+                block = tail_packed[tail_starts[position]:] + bases[-1]
+                block &= self.carry
+                hits = np.bitwise_count(block).sum(axis=1) >= min_traits
+                if symmetry:
+                    needs = tail_needs[tail_starts[position]:]
+                    hits &= (needs & ~np.uint64(state['mask'])) == 0
+                if limited:
+                    start = tail_starts[position]
+                    hits &= tail_spent[start:] <= budget - state['spent']
+                    for cost, spent in tail_used.items():
+                        hits &= spent[start:] <= caps[cost] - used[cost]
+                masks = tail_masks[tail_starts[position]:][hits]
+                results.extend((masks | np.uint64(state['mask'])).tolist())
+                return
+            if slots == 0:
+                if state['active'] >= min_traits:
+                    results.append(state['mask'])
+                return
+            for p in range(position, len(order) - slots + 1):
+                if potential(p, slots) < min_traits:
+                    break
+                if limited:
+                    if state['spent'] + cheapest[p][slots] > budget:
+                        break
+                    cost = unit_costs[order[p]]
+                    if state['spent'] + cost + \
+                            cheapest[p + 1][slots - 1] > budget or \
+                            used[cost] >= caps[cost]:
+                        continue
+                previous = predecessor[order[p]]
+                if previous is not None and not state['mask'] >> previous & 1:
+                    continue
+                push(order[p])
+                descend(p + 1, slots - 1)
+                pop(order[p])
+
+        if len(forced) <= level:
+            for i in forced:
+                push(i)
+            if not limited or limits.check_counts(state['spent'], used):
+                descend(0, level - len(forced))
+
+        if symmetry:
+            results = [comp for mask in results for comp in
+                       (self.expand(mask, classes) if mask & shared
+                        else [mask])]
+            if limited and len(results) > 0:
+                masks = np.array(results, dtype=np.uint64)
+                keep = limits.check(mask_rows(masks, level), self.costs)
+                results = masks[keep].tolist()
+
+        end_time = time.time()
+        print('Searched ' + str(state['visited']) + ' partial comps, found ' +
+              str(len(results)) + ' of length ' + str(level) + ':')
+        print_timer(end_time, start_time)
+
+        results.sort(key=mask_indices)
+        return [self.decode(mask) for mask in results]
+
+    def emblem_rows(self, unit, level, min_traits, batch_size=BATCH_SIZE):
+        # Only comps holding the emblem unit can change, and an extra trait
+        # copy never deactivates anything, so every other comp keeps its
+        # result. Yields each combination with unit that fails as is, along
+        # with its trait counts and active trait total.
+        for consumed, rows in self.combinations(level, force=[unit],
+                                                batch_size=batch_size):
+            counts = self.trait_counts(rows)
+            active = (counts >= self.mins).sum(axis=1)
+            failing = active < min_traits
+            yield rows[failing], counts[failing], active[failing]
+
+    def emblem_delta(self, unit, trait, level, min_traits):
+        start_time = time.time()
+
+        j = self.traits.index(trait)
+        masks = []
+        if trait not in unit.get_traits():
+            for rows, counts, active in self.emblem_rows(unit, level,
+                                                         min_traits):
+                gained = counts[:, j] + 1 == self.mins[j]
+                masks.extend(self.masks(rows[gained & (
+                    active + 1 >= min_traits)]).tolist())
+
+        end_time = time.time()
+        print('Emblem ' + trait.get_name() + ' on ' + unit.get_name() +
+              ' validates ' + str(len(masks)) + ' more comps:')
+        print_timer(end_time, start_time)
+
+        return [self.decode(mask) for mask in masks]
+
+    def emblem_gains(self, level, min_traits, units=None):
+        # gains[i][j]: comps newly valid with an emblem of trait j on unit i.
+        if units is None:
+            units = self.units
+        gains = np.zeros((len(units), len(self.traits)), dtype=np.int64)
+        for u, unit in enumerate(units):
+            for rows, counts, active in self.emblem_rows(unit, level,
+                                                         min_traits):
+                gained = (counts + 1 == self.mins) & \
+                    (active + 1 >= min_traits)[:, None]
+                gains[u] += gained.sum(axis=0)
+            gains[u, self.matrix[self.unit_index[unit]] > 0] = 0
+        return gains
+
+    def count_valid(self, level, min_traits, force=[]):
+        start_time = time.time()
+
+        forced = set(self.unit_index[unit] for unit in force)
+        # Units are added in an order that keeps few traits open at once. A
+        # state is (units taken, traits already closed and active, capped
+        # counts of the open traits) packed into one mixed radix int64, and
+        # a trait is folded into the active total after its last unit.
+        unit_traits = [np.flatnonzero(self.matrix[i]).tolist()
+                       for i in range(len(self.units))]
+        holders = [set(np.flatnonzero(self.matrix[:, j]).tolist())
+                   for j in range(len(self.traits))]
+        opened = set()
+
+        def opens(i):
+            return (sum(1 for j in unit_traits[i] if j not in opened) -
+                    sum(1 for j in unit_traits[i] if holders[j] == {i}), i)
+
+        order = []
+        remaining = set(range(len(self.units)))
+        while remaining:
+            i = min(remaining, key=opens)
+            order.append(i)
+            remaining.discard(i)
+            for j in unit_traits[i]:
+                opened.add(j)
+                holders[j].discard(i)
+        last = {}
+        for p, i in enumerate(order):
+            for j in unit_traits[i]:
+                last[j] = p
+
+        mins = np.maximum(self.mins.astype(np.int64), 0)
+        place = np.cumprod(np.concatenate([[1], mins + 1]))
+        used_place = int(place[-1])
+        active_place = used_place * (level + 1)
+        if active_place * (len(self.traits) + 1) >= 2 ** 63:
+            raise ValueError('Trait count states do not fit an int64 key.')
+        mins = mins.tolist()
+        place = place.tolist()
+        keys = np.zeros(1, dtype=np.int64)
+        totals = np.ones(1, dtype=np.int64)
+        closed = 0
+
+        def merge(keys, totals):
+            ordering = np.argsort(keys, kind='stable')
+            keys, totals = keys[ordering], totals[ordering]
+            starts = np.flatnonzero(np.concatenate([[True],
+                                                    keys[1:] != keys[:-1]]))
+            return keys[starts], np.add.reduceat(totals, starts)
+
+        for p, i in enumerate(order):
+            taking = keys // used_place % (level + 1) < level
+            taken = keys[taking] + used_place
+            for j in unit_traits[i]:
+                digit = taken // place[j] % (mins[j] + 1)
+                taken += (np.minimum(digit + int(self.matrix[i, j]), mins[j]) -
+                          digit) * place[j]
+            if i in forced:
+                keys, totals = taken, totals[taking]
+            else:
+                keys, totals = merge(np.concatenate([keys, taken]),
+                                     np.concatenate([totals,
+                                                     totals[taking]]))
+            for j in unit_traits[i]:
+                if last[j] == p:
+                    digit = keys // place[j] % (mins[j] + 1)
+                    keys = keys - digit * place[j] + \
+                        (digit >= mins[j]) * active_place
+                    closed += 1
+            keys, totals = merge(keys, totals)
+            # Drop states that can no longer fill the comp or reach
+            # min_traits even if every unclosed trait turned active.
+            used = keys // used_place % (level + 1)
+            alive = (level - used <= len(order) - p - 1) & \
+                (keys // active_place + len(self.traits) - closed >=
+                 min_traits)
+            keys, totals = keys[alive], totals[alive]
+
+        used = keys // used_place % (level + 1)
+        valid = (used == level) & (keys // active_place >= min_traits)
+        total = int(totals[valid].sum())
+
+        end_time = time.time()
+        print('Counted ' + str(total) + ' comps of length ' + str(level) +
+              ' with ' + str(min_traits) + ' or more traits:')
+        print_timer(end_time, start_time)
+
+        return total
+
+    def partition(self, pool):
+        # Split pool into two halves that share as few traits as possible,
+        # starting from units sorted by trait and swapping while it helps.
+        holds = self.matrix > 0
+        pool = sorted(pool, key=lambda i: np.flatnonzero(holds[i]).tolist())
+        side = np.zeros(len(self.units), dtype=bool)
+        side[pool[:len(pool) // 2]] = True
+        other = np.zeros(len(self.units), dtype=bool)
+        other[pool[len(pool) // 2:]] = True
+
+        def shared():
+            return holds[side].any(axis=0) & holds[other].any(axis=0)
+
+        best = int(shared().sum())
+        improved = True
+        while improved:
+            improved = False
+            for i in np.flatnonzero(side).tolist():
+                for j in np.flatnonzero(other).tolist():
+                    side[i], side[j], other[i], other[j] = \
+                        False, True, True, False
+                    if shared().sum() < best:
+                        best = int(shared().sum())
+                        improved = True
+                        break
+                    side[i], side[j], other[i], other[j] = \
+                        True, False, False, True
+                if improved:
+                    break
+        return np.flatnonzero(side), np.flatnonzero(other), \
+            np.flatnonzero(shared())
+
+    def half_buckets(self, pool, size, shared):
+        # Every size unit set of pool, sorted into buckets keyed by its
+        # capped counts of the shared traits in mixed radix, with the count
+        # of its other traits already active as the top digit.
+        own = (self.matrix[pool] > 0).any(axis=0)
+        own[shared] = False
+        mins = self.mins[shared].astype(np.int64)
+        place = np.cumprod(np.concatenate([[1], mins + 1]))
+        keys = []
+        masks = []
+        for rows in index_combinations(len(pool), size):
+            rows = pool[rows]
+            counts = np.zeros((len(rows), len(self.traits)), dtype=np.int8)
+            if size > 0:
+                counts = self.trait_counts(rows)
+            capped = np.minimum(counts, self.mins).astype(np.int64)
+            keys.append(capped[:, shared] @ place[:-1] +
+                        (capped[:, own] >= self.mins[own]).sum(axis=1) *
+                        place[-1])
+            masks.append(self.masks(rows))
+        if len(keys) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty, np.zeros(0, dtype=np.uint64)
+        keys = np.concatenate(keys)
+        masks = np.concatenate(masks)
+        ordering = np.argsort(keys, kind='stable')
+        keys, masks = keys[ordering], masks[ordering]
+        starts = np.flatnonzero(np.concatenate([[True],
+                                                keys[1:] != keys[:-1]]))
+        sizes = np.diff(np.append(starts, len(keys)))
+        return keys[starts], starts, sizes, masks
+
+    def join_masks(self, level, min_traits, unit_pool=None,
+                   batch_size=BATCH_SIZE):
+        if unit_pool is None:
+            unit_pool = self.units
+        pool = [self.unit_index[unit] for unit in unit_pool]
+        # Meet in the middle: unit sets of the two halves of partition() are
+        # bucketed by their shared trait counts, and for every split of level
+        # between the halves a compatibility table over bucket pairs says
+        # which combined comps reach min_traits. The halves are disjoint, so
+        # each comp is joined exactly once.
+        left, right, shared = self.partition(pool)
+        mins = self.mins[shared].astype(np.int64)
+        depth = int(mins.max(initial=0))
+        if len(shared) * depth > 64:
+            raise ValueError('Shared trait deficits do not fit a uint64 key.')
+        place = np.cumprod(np.concatenate([[1], mins + 1]))
+        # Bit (d - 1) * len(shared) + j stands for d copies of shared trait
+        # j. A left bucket sets the copies it is missing and a right bucket
+        # every count it holds, so the popcount of their AND is the number of
+        # shared traits the right half completes.
+        bit = np.left_shift(np.uint64(1), (
+            np.arange(depth)[:, None] * len(shared) +
+            np.arange(len(shared))).astype(np.uint64))
+        columns = np.arange(len(shared))
+        copies = np.arange(1, depth + 1)[:, None]
+
+        with span('join', level=level, traits=min_traits) as stage:
+            for size in range(max(0, level - len(right)),
+                              min(level, len(left)) + 1):
+                lkeys, lstarts, lsizes, lmasks = self.half_buckets(
+                    left, size, shared)
+                rkeys, rstarts, rsizes, rmasks = self.half_buckets(
+                    right, level - size, shared)
+                if len(lkeys) == 0 or len(rkeys) == 0:
+                    continue
+                capped = lkeys[:, None] // place[:-1] % (mins + 1)
+                missing = mins - capped
+                needs = np.bitwise_or.reduce(
+                    np.where(missing > 0,
+                             bit[np.maximum(missing, 1) - 1, columns],
+                             np.uint64(0)), axis=1)
+                lactive = lkeys // place[-1] + (missing == 0).sum(axis=1)
+                capped = rkeys[:, None] // place[:-1] % (mins + 1)
+                supplies = np.bitwise_or.reduce(
+                    np.where(capped[:, None, :] >= copies, bit, np.uint64(0)),
+                    axis=(1, 2))
+                ractive = rkeys // place[-1]
+
+                block = max(1, batch_size // len(rkeys))
+                for first in range(0, len(lkeys), block):
+                    wanted = min_traits - ractive - \
+                        lactive[first:first + block, None]
+                    compatible = np.bitwise_count(
+                        needs[first:first + block, None] & supplies) >= wanted
+                    lbuckets, rbuckets = np.nonzero(compatible)
+                    lbuckets += first
+                    pairs = int(lsizes[first:first + block].sum() *
+                                rsizes.sum())
+                    joined = int((lsizes[lbuckets] * rsizes[rbuckets]).sum())
+                    stage.count('generated', pairs)
+                    stage.count('few_traits', pairs - joined)
+                    stage.count('accepted', joined)
+                    for lrows, rrows in bucket_pairs(
+                            lstarts[lbuckets], lsizes[lbuckets],
+                            rstarts[rbuckets], rsizes[rbuckets],
+                            batch_size):
+                        yield lmasks[lrows] | rmasks[rrows]
+
+    def top_k(self, level, k, min_traits=0, force=[], weights=None,
+              cost_weight=0, limits=None):
+        start_time = time.time()
+
+        forced = [self.unit_index[unit] for unit in force]
+        weight = self.trait_weights(weights)
+        # A unit copy raises its trait by at most one tier, so a unit adds at
+        # most its weighted trait copies (plus its cost term) to the score.
+        gains = self.matrix @ np.maximum(weight, 0) + \
+            cost_weight * self.costs
+        order = sorted((i for i in range(len(self.units)) if i not in forced
+                        and (limits is None or
+                             limits.allows(self.units[i].get_cost()))),
+                       key=lambda i: (-gains[i], i))
+        best = [0.0] + list(itertools.accumulate(gains[i] for i in order))
+        unit_traits = [[(j, int(self.matrix[i, j]))
+                        for j in np.flatnonzero(self.matrix[i])]
+                       for i in range(len(self.units))]
+        mins = self.mins.tolist()
+        table = self.tier_table.tolist()
+        weight = weight.tolist()
+        costs = self.costs.tolist()
+        limited = limits is not None
+        if limited:
+            cheapest, budget, caps = self.cost_bounds(order, level, limits)
+            used = Counter()
+        counts = [0] * len(self.traits)
+        state = {'active': 0, 'score': 0.0, 'mask': 0, 'visited': 0,
+                 'spent': 0}
+        heap = []
+
+        def push(i):
+            state['mask'] |= 1 << i
+            state['score'] += cost_weight * costs[i]
+            if limited:
+                state['spent'] += costs[i]
+                used[costs[i]] += 1
+            for j, amount in unit_traits[i]:
+                before = counts[j]
+                counts[j] += amount
+                state['score'] += weight[j] * (table[j][counts[j]] -
+                                               table[j][before])
+                if before < mins[j] <= counts[j]:
+                    state['active'] += 1
+
+        def pop(i):
+            state['mask'] &= ~(1 << i)
+            state['score'] -= cost_weight * costs[i]
+            if limited:
+                state['spent'] -= costs[i]
+                used[costs[i]] -= 1
+            for j, amount in unit_traits[i]:
+                before = counts[j]
+                counts[j] -= amount
+                state['score'] -= weight[j] * (table[j][before] -
+                                               table[j][counts[j]])
+                if counts[j] < mins[j] <= before:
+                    state['active'] -= 1
+
+        def descend(position, slots):
+            state['visited'] += 1
+            if slots == 0:
+                if state['active'] >= min_traits:
+                    # Ties with the k-th score keep the comps found first.
+                    entry = (state['score'], -state['mask'])
+                    if len(heap) < k:
+                        heapq.heappush(heap, entry)
+                    elif entry[0] > heap[0][0]:
+                        heapq.heapreplace(heap, entry)
+                return
+            for p in range(position, len(order) - slots + 1):
+                bound = state['score'] + best[p + slots] - best[p]
+                if len(heap) == k and bound <= heap[0][0]:
+                    break
+                if limited:
+                    if state['spent'] + cheapest[p][slots] > budget:
+                        break
+                    cost = costs[order[p]]
+                    if state['spent'] + cost + \
+                            cheapest[p + 1][slots - 1] > budget or \
+                            used[cost] >= caps[cost]:
+                        continue
+                push(order[p])
+                descend(p + 1, slots - 1)
+                pop(order[p])
+
+        if 0 < k and len(forced) <= level:
+            for i in forced:
+                push(i)
+            if not limited or limits.check_counts(state['spent'], used):
+                descend(0, level - len(forced))
+
+        end_time = time.time()
+        print('Searched ' + str(state['visited']) + ' partial comps, kept ' +
+              str(len(heap)) + ' best of length ' + str(level) + ':')
+        print_timer(end_time, start_time)
+
+        ranked = sorted(heap, reverse=True)
+        return [(score, self.decode(-mask)) for score, mask in ranked]
+
+    def hybrid_masks(self, split, groups, forced=0, traits=0, leads=None,
+                     deadline=None):
+        # groups holds the candidate part masks for sizes 4, 3, 2 and 1.
+        # Slots are filled in that order with pairwise disjoint parts, and a
+        # unit set is emitted only from its lexicographically first
+        # decomposition, so every set appears once. With traits > 0 partial
+        # decompositions that cannot reach that many active traits are cut.
+        groups = [np.asarray(masks).tolist() for masks in groups]
+        lookups = [{mask: i for i, mask in enumerate(masks)}
+                   for masks in groups]
+        sizes = [4, 3, 2, 1]
+        slots = [g for g, size in enumerate(sizes)
+                 for _ in range(split.count(size))]
+        later = [slots[t + 1:].count(slots[t]) for t in range(len(slots))]
+        level = bin(forced).count('1') + sum(split)
+        unit_traits = [[(j, int(self.matrix[i, j]))
+                        for j in np.flatnonzero(self.matrix[i])]
+                       for i in range(len(self.matrix))]
+        mins = self.mins.tolist()
+        multiplicity = self.matrix.max(axis=0).tolist()
+        reachable = self.matrix.sum(axis=0).tolist()
+        sizes_by_copies = sorted(self.matrix.sum(axis=1).tolist(),
+                                 reverse=True)
+        supply = [0] + list(itertools.accumulate(sizes_by_copies[:level]))
+        counts = [0] * self.matrix.shape[1]
+        state = {'active': 0}
+        decomposition = []
+
+        def push(mask):
+            for i in mask_indices(mask):
+                for j, amount in unit_traits[i]:
+                    before = counts[j]
+                    counts[j] += amount
+                    if before < mins[j] <= counts[j]:
+                        state['active'] += 1
+
+        def pop(mask):
+            for i in mask_indices(mask):
+                for j, amount in unit_traits[i]:
+                    before = counts[j]
+                    counts[j] -= amount
+                    if counts[j] < mins[j] <= before:
+                        state['active'] -= 1
+
+        def first_option(t, start):
+            if t > 0 and slots[t - 1] == slots[t]:
+                return start
+            return 0
+
+        def canonical(comp):
+            # comp is canonical when no decomposition sorts before the one
+            # being built, trying only the parts that fit inside comp.
+            units = mask_indices(comp)
+            fits = {}
+            for g in set(slots):
+                found = []
+                for part in itertools.combinations(units, sizes[g]):
+                    i = lookups[g].get(sum(1 << unit for unit in part))
+                    if i is not None:
+                        found.append((i, groups[g][i]))
+                fits[g] = sorted(found)
+            if all(len(fits[g]) == slots.count(g) for g in fits):
+                return True
+
+            def options(t, start, remaining):
+                start = first_option(t, start)
+                return [(i, mask) for i, mask in fits[slots[t]]
+                        if i >= start and not mask & ~remaining]
+
+            def completable(t, start, remaining):
+                if t == len(slots):
+                    return True
+                if all(sizes[g] == 1 for g in slots[t:]):
+                    return all(1 << i in lookups[-1]
+                               for i in mask_indices(remaining))
+                for i, mask in options(t, start, remaining):
+                    if completable(t + 1, i + 1, remaining & ~mask):
+                        return True
+                return False
+
+            def smaller_exists(t, start, remaining):
+                if t == len(slots):
+                    return False
+                for i, mask in options(t, start, remaining):
+                    if i == decomposition[t]:
+                        return smaller_exists(t + 1, i + 1,
+                                              remaining & ~mask)
+                    if completable(t + 1, i + 1, remaining & ~mask):
+                        return True
+                return False
+
+            return not smaller_exists(0, 0, comp)
+
+        # Parts tried, and why unit sets were dropped, for span('hybrid').
+        tally = dict.fromkeys(STAGE_COUNTS, 0)
+
+        def fill(t, start, used, placed):
+            if t == len(slots):
+                if state['active'] < traits:
+                    tally['few_traits'] += 1
+                elif not canonical(used & ~forced):
+                    tally['duplicate'] += 1
+                else:
+                    tally['accepted'] += 1
+                    yield used
+                return
+            masks = groups[slots[t]]
+            first = first_option(t, start)
+            last = len(masks) - later[t]
+            if t == 0 and leads is not None:
+                first, last = max(first, leads.start), min(last, leads.stop)
+            if t == len(slots) - 1 and sizes[slots[t]] == 1:
+                # Last singleton slot: score each unit without pushing it.
+                needed = traits - state['active']
+                tally['generated'] += max(0, last - first)
+                overlapping = 0
+                few_traits = 0
+                for i in range(first, last):
+                    if masks[i] & used:
+                        overlapping += 1
+                        continue
+                    gained = 0
+                    for j, amount in unit_traits[masks[i].bit_length() - 1]:
+                        if counts[j] < mins[j] <= counts[j] + amount:
+                            gained += 1
+                    if gained < needed:
+                        few_traits += 1
+                        continue
+                    decomposition.append(i)
+                    if canonical((used | masks[i]) & ~forced):
+                        tally['accepted'] += 1
+                        yield used | masks[i]
+                    else:
+                        tally['duplicate'] += 1
+                    decomposition.pop()
+                tally['overlapping'] += overlapping
+                tally['few_traits'] += few_traits
+                return
+            tally['generated'] += max(0, last - first)
+            overlapping = 0
+            for i in range(first, last):
+                if masks[i] & used:
+                    overlapping += 1
+                    continue
+                if deadline is not None and time.time() > deadline:
+                    return
+                push(masks[i])
+                size = placed + sizes[slots[t]]
+                if traits <= 0 or size == level or \
+                        state['active'] + reachable_traits(
+                            counts, mins, reachable, multiplicity,
+                            level - size, supply[level - size]) >= traits:
+                    decomposition.append(i)
+                    yield from fill(t + 1, i + 1, used | masks[i], size)
+                    decomposition.pop()
+                else:
+                    tally['few_traits'] += 1
+                pop(masks[i])
+            tally['overlapping'] += overlapping
+
+        with span('hybrid', split=split, traits=traits) as stage:
+            stage.track(tally)
+            push(forced)
+            placed = bin(forced).count('1')
+            if traits <= 0 or state['active'] + reachable_traits(
+                    counts, mins, reachable, multiplicity, level - placed,
+                    supply[level - placed]) >= traits:
+                yield from fill(0, 0, forced, placed)
+            pop(forced)
+
+    def encode_batches(self, comps, level, unwraps=0, batch_size=BATCH_SIZE,
+                       unique=False):
+        if isinstance(comps, IndexBatches):
+            yield from comps
+            return
+        rows = []
+        consumed = 0
+        for team in comps:
+            consumed += 1
+            if unique:
+                rows.append([self.unit_index[unit] for unit in team])
+            else:
+                flattened_team = team
+                for _ in range(unwraps):
+                    flattened_team = flatten_once(flattened_team)
+                flattened_team = set(flattened_team)
+                if len(flattened_team) == level:
+                    rows.append([self.unit_index[unit]
+                                 for unit in flattened_team])
+            if consumed == batch_size:
+                yield consumed, np.array(rows, dtype=np.intp).reshape(-1,
+                                                                      level)
+                rows = []
+                consumed = 0
+        if consumed > 0:
+            yield consumed, np.array(rows, dtype=np.intp).reshape(-1, level)
+
+
+class RosterSnapshot:
+    def __init__(self, arrays):
+        # Read-only arrays of a compiled set: unit and trait ids are row
+        # positions, masks are uint64 bitsets over unit ids.
+        self.arrays = {}
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            array.flags.writeable = False
+            self.arrays[name] = array
+
+    def get_unit_names(self):
+        return self.arrays['unit_names'].tolist()
+
+    def get_trait_names(self):
+        return self.arrays['trait_names'].tolist()
+
+    def get_costs(self):
+        return self.arrays['roster_costs']
+
+    def get_matrix(self):
+        return self.arrays['roster_matrix']
+
+    def get_tier_table(self):
+        return self.arrays['roster_tier_table']
+
+    def get_neighbor_masks(self):
+        return self.arrays['neighbor_masks']
+
+    def get_trait_masks(self):
+        return self.arrays['trait_masks']
+
+    def get_classes(self):
+        labels = self.arrays['classes']
+        return [np.flatnonzero(labels == label).tolist()
+                for label in range(int(labels.max(initial=-1)) + 1)]
+
+    def get_roster(self):
+        # The same state a pickled Roster carries to pool workers: every
+        # scoring array, none of the Node and Trait objects.
+        roster = Roster.__new__(Roster)
+        for name, array in self.arrays.items():
+            if name.startswith('roster_'):
+                roster.__dict__[name[len('roster_'):]] = \
+                    array.item() if array.ndim == 0 else array
+        return roster
+
+
+def reachable_traits(counts, mins, reachable, multiplicity, slots, budget):
+    missing = []
+    for j in range(len(counts)):
+        deficit = mins[j] - counts[j]
+        if 0 < deficit <= reachable[j] and deficit <= slots * multiplicity[j]:
+            missing.append(deficit)
+    # Each reachable trait still needs its missing copies, and the remaining
+    # slots can only supply so many trait copies in total.
+    possible = 0
+    for deficit in sorted(missing):
+        if deficit > budget:
+            break
+        budget -= deficit
+        possible += 1
+    return possible
+
+
+def mask_indices(mask):
+    indices = []
+    while mask:
+        low = mask & -mask
+        indices.append(low.bit_length() - 1)
+        mask ^= low
+    return indices
+
+
+def bucket_pairs(lstarts, lsizes, rstarts, rsizes, batch_size=BATCH_SIZE):
+    # Row pairs of every left and right member of paired buckets, in chunks
+    # of about batch_size pairs.
+    widths = lsizes * rsizes
+    ends = np.cumsum(widths)
+    start = 0
+    while start < len(widths):
+        stop = np.searchsorted(ends, ends[start] - widths[start] + batch_size,
+                               side='right')
+        stop = max(stop, start + 1)
+        chunk = widths[start:stop]
+        offsets = np.arange(chunk.sum()) - np.repeat(np.cumsum(chunk) - chunk,
+                                                     chunk)
+        heights = np.repeat(rsizes[start:stop], chunk)
+        yield (np.repeat(lstarts[start:stop], chunk) + offsets // heights,
+               np.repeat(rstarts[start:stop], chunk) + offsets % heights)
+        start = stop
+
+
+def mask_rows(masks, level):
+    # Ascending unit indices of uint64 masks that all hold level units.
+    bits = np.unpackbits(np.asarray(masks, dtype='<u8').view(np.uint8)
+                         .reshape(-1, 8), axis=1, bitorder='little')
+    return np.nonzero(bits)[1].reshape(-1, level).astype(np.intp)
+
+
+def store_column(path, name, shape):
+    if 0 in shape:
+        return np.zeros(shape, dtype=STORE_DTYPES[name])
+    return np.memmap(os.path.join(path, name + '.bin'),
+                     dtype=STORE_DTYPES[name], mode='r', shape=shape)
+
+
+@lru_cache(maxsize=64)
+def combination_table(n, k):
+    table = np.array(list(itertools.combinations(range(n), k)),
+                     dtype=np.intp).reshape(-1, k)
+    table.flags.writeable = False
+    return table
+
+
+def index_combinations(n, k, batch_size=BATCH_SIZE):
+    if k > n:
+        return
+    if k == 0:
+        yield np.zeros((1, 0), dtype=np.intp)
+        return
+    width = k
+    while width > 1 and math.comb(n, width) > batch_size:
+        width -= 1
+    tail = combination_table(n, width)
+    if width == k:
+        for start in range(0, len(tail), batch_size):
+            yield tail[start:start + batch_size]
+        return
+    starts = np.searchsorted(tail[:, 0], np.arange(n + 1))
+    prefixes = itertools.combinations(range(n - width), k - width)
+    while True:
+        chunk = np.array(list(itertools.islice(prefixes, 4096)),
+                         dtype=np.intp)
+        if len(chunk) == 0:
+            return
+        offsets = starts[chunk[:, -1] + 1]
+        lengths = len(tail) - offsets
+        ends = np.cumsum(lengths)
+        first = 0
+        while first < len(chunk):
+            last = np.searchsorted(ends, ends[first] - lengths[first] +
+                                   batch_size, side='right')
+            last = max(last, first + 1)
+            block_lengths = lengths[first:last]
+            total = int(block_lengths.sum())
+            rows = np.empty((total, k), dtype=np.intp)
+            rows[:, :k - width] = np.repeat(chunk[first:last], block_lengths,
+                                            axis=0)
+            block_starts = np.repeat(np.cumsum(block_lengths) - block_lengths,
+                                     block_lengths)
+            rows[:, k - width:] = tail[np.arange(total) - block_starts +
+                                       np.repeat(offsets[first:last],
+                                                 block_lengths)]
+            if total > 0:
+                yield rows
+            first = last
+
+
 def build_graph(unit_pool):
+    for i, unit in enumerate(unit_pool):
+        unit.id = i
     for unit in unit_pool:
         unit.set_neighbors()
+    return Graph(unit_pool)
 
 
 def trait_potential(comp, comp_size, trait_pool):
@@ -96,29 +1629,88 @@ def check_active(units):
     return active
 
 
-def iterate_seeded_growth(comp_pool):
-    results = []
-    excluded = []
+def check_tiers(units):
+    trait_counts = Counter()
+    tiers = Counter()
+    for unit in units:
+        for trait in unit.get_traits():
+            trait_counts[trait] += 1
+    for trait in trait_counts:
+        reached = sum(1 for tier in trait.tiers if tier <= trait_counts[trait])
+        if reached > 0:
+            tiers[trait.get_name()] = reached
+    return tiers
+
+
+def connected_subsets(level, unit_pool, force=[]):
+    # ESU-style canonical extension: every connected unit set containing
+    # force (or rooted at its lowest index unit) is produced exactly once.
+    index = {unit: i for i, unit in enumerate(unit_pool)}
+    adjacency = [0] * len(unit_pool)
+    for i, unit in enumerate(unit_pool):
+        for neighbor in unit.get_neighbors():
+            if neighbor in index:
+                adjacency[i] |= 1 << index[neighbor]
+
+    def extend(subset, extension, closed, root):
+        if len(subset) == level:
+            yield tuple(sorted((unit_pool[i] for i in subset),
+                               key=lambda x: (x.cost, x.name)))
+            return
+        # Units past root only, taken lowest index first.
+        above = ~((1 << root + 1) - 1)
+        while extension:
+            low = extension & -extension
+            extension ^= low
+            node = low.bit_length() - 1
+            exclusive = adjacency[node] & above & ~closed
+            yield from extend(subset + [node], exclusive | extension,
+                              closed | adjacency[node] | low, root)
+
+    if len(force) > level:
+        return
+    if len(force) > 0:
+        subset = [index[unit] for unit in force]
+        closed = sum(1 << i for i in set(subset))
+        for i in subset:
+            closed |= adjacency[i]
+        yield from extend(subset, closed & ~sum(1 << i for i in set(subset)),
+                          closed, -1)
+        return
+    for root in range(len(unit_pool)):
+        yield from extend([root], adjacency[root] & ~((1 << root + 1) - 1),
+                          adjacency[root] | 1 << root, root)
+
+
+def seeded_growth(comp_pool):
+    # One step of the original breadth-first growth: every team plus one
+    # neighbor, skipping neighbors that were already used as a seed. The
+    # set matches connected_subsets(); the order is what the hybrid splits
+    # were tuned on, so branch_masks() keeps it.
+    results = {}
+    excluded = set()
     prev_seed = None
     for team in comp_pool:
-        neighbors = []
         current_seed = team[0]
         if current_seed != prev_seed and prev_seed is not None:
-            excluded.append(prev_seed)
+            excluded.add(prev_seed)
+        neighbors = {}
         for node in team:
             for neighbor in node.get_neighbors():
-                if neighbor not in team and neighbor not in neighbors:
-                    if neighbor not in excluded:
-                        neighbors.append(neighbor)
+                if neighbor not in team and neighbor not in excluded:
+                    neighbors[neighbor] = None
         for neighbor in neighbors:
-            sorted_team = tuple(sorted(team + (neighbor,), key=lambda x:
-                                       (x.cost, x.name)))
-            if sorted_team not in results:
-                results.append(sorted_team)
+            results.setdefault(tuple(sorted(team + (neighbor,), key=lambda x:
+                                            (x.cost, x.name))), None)
         prev_seed = current_seed
-    sorted_results = list(sorted(results, key=lambda x: (x[0].cost,
-                                                         x[0].name)))
-    return sorted_results
+    return sorted(results, key=lambda x: (x[0].cost, x[0].name))
+
+
+def seeded_branches(level, unit_pool):
+    branches = [tuple([unit]) for unit in unit_pool]
+    for _ in range(level - 1):
+        branches = seeded_growth(branches)
+    return branches
 
 
 def flatten_once(seq):
@@ -133,44 +1725,251 @@ def print_timer(end, start):
     print("         Took " + str(end - start) + " seconds to complete.")
 
 
-def get_hybrid(split, unit_pool, trait_pool, force=[]):
-    start_time = time.time()
+def peak_memory():
+    # Peak resident set size of the process so far in MB (KB on Linux).
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
-    branches_2 = []
-    branches_3 = []
-    branches_4 = []
 
-    units = [tuple([unit]) for unit in unit_pool]
-    if 2 in split or 3 in split or 4 in split:
-        branches_2 = iterate_seeded_growth(units)
-        if 3 in split or 4 in split:
-            branches_3 = iterate_seeded_growth(branches_2)
-            if 4 in split:
-                branches_4 = iterate_seeded_growth(branches_3)
+class Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.counts = dict.fromkeys(STAGE_COUNTS, 0)
+        self.start = 0.0
+        self.end = 0.0
+        self.peak = 0.0
 
-    for branch in branches_2:
-        current, potential = trait_potential(branch, 3, trait_pool)
-        if current < 2 and potential < 3:
-            branches_2.remove(branch)
-    for branch in branches_3:
-        current, potential = trait_potential(branch, 4, trait_pool)
-        if current < 3 and potential < 4:
-            branches_3.remove(branch)
-    for branch in branches_4:
-        current, potential = trait_potential(branch, 5, trait_pool)
-        if current < 4 and potential < 5:
-            branches_4.remove(branch)
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
 
-    ones = itertools.combinations(unit_pool, split.count(1))
-    twos = itertools.combinations(branches_2, split.count(2))
-    threes = itertools.combinations(branches_3, split.count(3))
-    fours = itertools.combinations(branches_4, split.count(4))
+    def __exit__(self, *exc):
+        self.end = time.perf_counter()
+        self.peak = peak_memory()
+        self.tracer.spans.append(self)
+        return False
 
-    final_comps = itertools.product(fours, threes, twos, ones)
-    unwraps = 1
-    if len(force) > 0:
-        final_comps = itertools.product(final_comps, [tuple(force)])
-        unwraps += 1
+    def count(self, key, amount=1):
+        self.counts[key] += amount
+
+    def track(self, counts):
+        # Hot loops keep their own counts dict; the span reports it live.
+        self.counts = counts
+
+    def record(self, origin):
+        seconds = self.end - self.start
+        return {'name': self.name, 'args': self.args,
+                'start': self.start - origin, 'seconds': seconds,
+                'counts': dict(self.counts),
+                'per_second': self.counts['generated'] / seconds
+                if seconds > 0 else 0.0,
+                'peak_memory_mb': self.peak}
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, key, amount=1):
+        pass
+
+    def track(self, counts):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans = []
+
+    def get_spans(self):
+        return self.spans
+
+    def records(self):
+        return [current.record(self.origin)
+                for current in sorted(self.spans, key=lambda x: x.start)]
+
+    def chrome_events(self):
+        # Complete ("X") events in microseconds, loadable in about:tracing
+        # or Perfetto, with the stage counts as event args.
+        events = []
+        for record in self.records():
+            args = dict(record['args'])
+            args.update(record['counts'])
+            args['per_second'] = record['per_second']
+            args['peak_memory_mb'] = record['peak_memory_mb']
+            events.append({'name': record['name'], 'cat': 'stage',
+                           'ph': 'X', 'ts': record['start'] * 1e6,
+                           'dur': record['seconds'] * 1e6,
+                           'pid': os.getpid(), 'tid': 0, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path, format='json'):
+        if format == 'chrome':
+            body = self.chrome_events()
+        elif format == 'json':
+            body = {'spans': self.records()}
+        else:
+            raise ValueError('Unknown trace format ' + format + '.')
+        with open(path, 'w') as file:
+            json.dump(body, file, indent=1, default=str)
+
+
+def start_tracing():
+    global TRACER
+    TRACER = Tracer()
+    return TRACER
+
+
+def stop_tracing():
+    global TRACER
+    tracer, TRACER = TRACER, None
+    return tracer
+
+
+def span(name, **args):
+    if TRACER is None:
+        return NULL_SPAN
+    return Span(TRACER, name, args)
+
+
+def traced(name, items, **args):
+    # Count items (or IndexBatches candidates) as they are consumed. With
+    # tracing off the items come back untouched.
+    if TRACER is None:
+        return items
+    batched = isinstance(items, IndexBatches)
+
+    def counted():
+        with span(name, **args) as current:
+            for item in items:
+                current.count('generated', item[0] if batched else 1)
+                yield item
+
+    if batched:
+        return IndexBatches(counted())
+    return counted()
+
+
+def export_trace():
+    if TRACER is not None:
+        TRACER.export(os.environ['GRAPH_TRACE'],
+                      os.environ.get('GRAPH_TRACE_FORMAT', 'json'))
+
+
+if os.environ.get('GRAPH_TRACE'):
+    # GRAPH_TRACE=path traces any run and writes the spans at exit, as
+    # GRAPH_TRACE_FORMAT (json or chrome).
+    start_tracing()
+    atexit.register(export_trace)
+
+
+def prune_branches(branches, comp_size, trait_pool):
+    # Same survivors as calling branches.remove() while iterating: the
+    # branch right after each removed one is kept without being checked.
+    kept = []
+    skip = False
+    with span('prune', comp_size=comp_size) as stage:
+        for branch in branches:
+            if skip:
+                kept.append(branch)
+                skip = False
+                continue
+            current, potential = trait_potential(branch, comp_size,
+                                                 trait_pool)
+            if current < comp_size - 1 and potential < comp_size:
+                skip = True
+            else:
+                kept.append(branch)
+        stage.count('generated', len(branches))
+        stage.count('few_traits', len(branches) - len(kept))
+        stage.count('accepted', len(kept))
+    return kept
+
+
+def branch_masks(level, unit_pool, trait_pool, roster,
+                 cache_dir=BRANCH_CACHE):
+    # Pruned branches of one length as uint64 masks, in seeded_growth()
+    # order. The file name hashes everything the list depends on, so a
+    # changed roster, threshold or growth order simply misses the cache.
+    key = hashlib.sha1(('seeded|' + roster.fingerprint() + '|' +
+                        ','.join(unit.name for unit in unit_pool) + '|' +
+                        ','.join(trait.name for trait in trait_pool) + '|' +
+                        str(level) + '|' + str(level + 1)).encode())
+    path = os.path.join(cache_dir, 'branches_' + str(level) + '_' +
+                        key.hexdigest()[:16] + '.npy')
+    if not os.path.exists(path):
+        branches = prune_branches(
+            list(traced('branches', seeded_branches(level, unit_pool),
+                        level=level)), level + 1, trait_pool)
+        masks = np.array([roster.encode(branch) for branch in branches],
+                         dtype=np.uint64)
+        os.makedirs(cache_dir, exist_ok=True)
+        partial = path + '.' + str(os.getpid()) + '.tmp'
+        with open(partial, 'wb') as file:
+            np.save(file, masks)
+        os.replace(partial, path)
+    return np.load(path, mmap_mode='r')
+
+
+def hybrid_groups(split, unit_pool, trait_pool, roster,
+                  cache_dir=BRANCH_CACHE):
+    groups = []
+    for size in [4, 3, 2]:
+        if size in split:
+            groups.append(branch_masks(size, unit_pool, trait_pool, roster,
+                                       cache_dir))
+        else:
+            groups.append(np.zeros(0, dtype=np.uint64))
+    groups.append(np.array([roster.encode([unit]) for unit in unit_pool],
+                           dtype=np.uint64))
+    return groups
+
+
+def split_partitions(level, largest=4):
+    # Every split of level into parts of at most largest units, ordered
+    # like the hand-written rows: all singletons first, then ascending.
+    partitions = []
+
+    def extend(remaining, cap, parts):
+        if remaining == 0:
+            partitions.append(parts)
+            return
+        for size in range(min(remaining, cap), 0, -1):
+            extend(remaining - size, size, parts + [size])
+
+    extend(level, largest, [])
+    return sorted(partitions)
+
+
+def lead_count(split, groups):
+    # Number of parts hybrid_masks() can place in its first slot.
+    for g, size in enumerate([4, 3, 2, 1]):
+        if size in split:
+            return max(0, len(groups[g]) - split.count(size) + 1)
+    return 0
+
+
+def get_hybrid(split, unit_pool, trait_pool, force=[], roster=None,
+               traits=0):
+    start_time = time.time()
+
+    if roster is None:
+        roster = Roster(unit_pool, trait_pool)
+    groups = hybrid_groups(split, unit_pool, trait_pool, roster)
+    final_comps = (tuple(roster.units[i] for i in mask_indices(mask))
+                   for mask in roster.hybrid_masks(split, groups,
+                                                   roster.encode(force),
+                                                   traits))
 
     end_time = time.time()
     print('Gathered combinations of splits ' + str(split) + ":")
@@ -181,16 +1980,9 @@ def get_hybrid(split, unit_pool, trait_pool, force=[]):
 
 def get_branches(level, unit_pool, force=[]):
     start_time = time.time()
-    final_comps = force
-    if len(force) > level:
-        return []
-    if len(force) < level:
-        if len(force) > 0:
-            final_comps = iterate_seeded_growth([force])
-        else:
-            final_comps = [tuple([unit]) for unit in unit_pool]
-        for _ in range(level - len(force) - 1):
-            final_comps = iterate_seeded_growth(final_comps)
+    final_comps = traced('branches',
+                         connected_subsets(level, unit_pool, force),
+                         level=level)
 
     end_time = time.time()
     print('Traversed branches of length ' + str(level) + ":")
@@ -199,14 +1991,17 @@ def get_branches(level, unit_pool, force=[]):
     return final_comps
 
 
-def get_combinations(level, unit_pool, force=[]):
+def get_combinations(level, unit_pool, force=[], roster=None):
     start_time = time.time()
 
     final_comps = []
-    if len(force) < level:
+    if roster is not None:
+        final_comps = roster.combinations(level, unit_pool, force)
+    elif len(force) < level:
         final_comps = itertools.combinations(unit_pool, level - len(force))
-    if len(force) > 0:
+    if len(force) > 0 and roster is None:
         final_comps = itertools.product(final_comps, [force])
+    final_comps = traced('combinations', final_comps, level=level)
 
     end_time = time.time()
     print('Generated combinations of length ' + str(level) + ":")
@@ -215,144 +2010,727 @@ def get_combinations(level, unit_pool, force=[]):
     return final_comps
 
 
-def validate(comps, level, traits, unwraps=0):
+def get_joined(level, unit_pool, trait_pool, traits, roster=None):
+    start_time = time.time()
+
+    if roster is None:
+        roster = Roster(unit_pool, trait_pool)
+    final_comps = IndexBatches((len(masks), mask_rows(masks, level))
+                               for masks in roster.join_masks(level, traits,
+                                                              unit_pool))
+
+    end_time = time.time()
+    print('Joined halves of length ' + str(level) + ":")
+    print_timer(end_time, start_time)
+
+    return final_comps
+
+
+def iter_validate(comps, level, traits, unwraps=0, roster=None, unique=False,
+                  sink=None):
     start_time = time.time()
 
+    seen = SeenMasks()
+    unit_bits = {}
+    tally = dict.fromkeys(STAGE_COUNTS, 0)
+
+    with span('validate', level=level, traits=traits) as stage:
+        stage.track(tally)
+        if roster is None:
+            for team in comps:
+                tally['generated'] += 1
+                if not unique:
+                    for _ in range(unwraps):
+                        team = flatten_once(team)
+                team = set(team)
+                if not unique and len(team) != level:
+                    tally['overlapping'] += 1
+                    continue
+                if len(check_active(team)) < traits:
+                    tally['few_traits'] += 1
+                    continue
+                if not unique:
+                    mask = 0
+                    for unit in team:
+                        mask |= 1 << unit_bits.setdefault(unit,
+                                                          len(unit_bits))
+                    if not seen.add(mask):
+                        tally['duplicate'] += 1
+                        continue
+                tally['accepted'] += 1
+                if sink is not None:
+                    sink.write(team)
+                yield team
+        else:
+            for consumed, rows in roster.encode_batches(comps, level,
+                                                        unwraps,
+                                                        unique=unique):
+                tally['generated'] += consumed
+                tally['overlapping'] += consumed - len(rows)
+                if len(rows) == 0:
+                    continue
+                masks = roster.masks(rows[roster.count_active(rows) >=
+                                          traits])
+                tally['few_traits'] += len(rows) - len(masks)
+                if not unique:
+                    fresh = seen.add_new(masks)
+                    tally['duplicate'] += len(masks) - len(fresh)
+                    masks = fresh
+                for mask in masks.tolist():
+                    team = roster.decode(mask)
+                    tally['accepted'] += 1
+                    if sink is not None:
+                        sink.write(team)
+                    yield team
+    all_comps = tally['generated']
+    validated_comps = tally['accepted']
+
+    end_time = time.time()
+    print('Validated ' + str(validated_comps) + ' comps out of ' +
+          str(all_comps) + ':')
+    print_timer(end_time, start_time)
+
+
+def validate(comps, level, traits, unwraps=0, roster=None, unique=False,
+             sink=None):
+    return list(iter_validate(comps, level, traits, unwraps, roster, unique,
+                              sink))
+
+
+def chunk_candidates(comps, level, unwraps=0, roster=None, unique=False,
+                     chunk_size=BATCH_SIZE):
+    # Pipeline stage one: candidates as (consumed, index rows) chunks of at
+    # most chunk_size. Batches that are already encoded are only split.
+    if not isinstance(comps, IndexBatches):
+        yield from roster.encode_batches(comps, level, unwraps, chunk_size,
+                                         unique)
+        return
+    for consumed, rows in comps:
+        for start in range(0, len(rows), chunk_size):
+            piece = rows[start:start + chunk_size]
+            if start + chunk_size >= len(rows):
+                yield consumed - start, piece
+            else:
+                yield len(piece), piece
+        if len(rows) == 0 and consumed > 0:
+            yield consumed, rows
+
+
+def bounded(items, depth=PIPELINE_DEPTH):
+    # Run items on a thread behind a queue of depth entries, so the
+    # producer stalls instead of racing ahead of a slower consumer.
+    channel = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def offer(entry):
+        while not stop.is_set():
+            try:
+                channel.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not offer((None, item)):
+                    return
+        except BaseException as error:
+            offer((error, done))
+            return
+        offer((None, done))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            error, item = channel.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def load_chunk_context(roster, traits):
+    global chunk_context
+    if isinstance(roster, str):
+        roster = load_snapshot(roster).get_roster()
+    chunk_context = (roster, traits)
+
+
+def validate_chunk(chunk):
+    roster, traits = chunk_context
+    consumed, rows = chunk
+    if len(rows) == 0 or rows.shape[1] == 0:
+        return consumed, len(rows), roster.masks(rows)
+    return consumed, len(rows), roster.masks(
+        rows[roster.count_active(rows) >= traits])
+
+
+def validate_chunks(chunks, traits, roster, workers=None,
+                    depth=PIPELINE_DEPTH, snapshot=None):
+    # Pipeline stage two: (consumed, encoded, masks) per chunk, in chunk
+    # order. At most depth chunks per worker are in flight at once.
+    if workers == 0:
+        load_chunk_context(roster, traits)
+        yield from map(validate_chunk, chunks)
+        return
+    if workers is None:
+        workers = os.cpu_count()
+    with ProcessPoolExecutor(workers, initializer=load_chunk_context,
+                             initargs=(snapshot or roster,
+                                       traits)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(validate_chunk, chunk))
+            if len(pending) >= depth * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def merge_masks(results, unique=False, tally=None):
+    # Pipeline stage three: drop masks seen in earlier chunks and emit the
+    # rest, counting every stage's losses into tally.
+    if tally is None:
+        tally = dict.fromkeys(STAGE_COUNTS, 0)
+    seen = SeenMasks()
+    for consumed, encoded, masks in results:
+        tally['generated'] += consumed
+        tally['overlapping'] += consumed - encoded
+        tally['few_traits'] += encoded - len(masks)
+        if not unique:
+            fresh = seen.add_new(masks)
+            tally['duplicate'] += len(masks) - len(fresh)
+            masks = fresh
+        tally['accepted'] += len(masks)
+        if len(masks) > 0:
+            yield masks
+
+
+def iter_pipeline(comps, level, traits, roster, unwraps=0, unique=False,
+                  sink=None, chunk_size=BATCH_SIZE, depth=PIPELINE_DEPTH,
+                  workers=None, snapshot=None):
+    # iter_validate() with generation on a thread, validation on workers
+    # and a merger, joined by bounded queues so the stages overlap.
+    start_time = time.time()
+
+    tally = dict.fromkeys(STAGE_COUNTS, 0)
+    with span('pipeline', level=level, traits=traits,
+              chunk_size=chunk_size) as stage:
+        stage.track(tally)
+        chunks = bounded(chunk_candidates(comps, level, unwraps, roster,
+                                          unique, chunk_size), depth)
+        results = validate_chunks(chunks, traits, roster, workers, depth,
+                                  snapshot)
+        for masks in merge_masks(results, unique, tally):
+            for mask in masks.tolist():
+                team = roster.decode(mask)
+                if sink is not None:
+                    sink.write(team)
+                yield team
+
+    end_time = time.time()
+    print('Validated ' + str(tally['accepted']) + ' comps out of ' +
+          str(tally['generated']) + ' through the pipeline:')
+    print_timer(end_time, start_time)
+
+
+def validate_pipelined(comps, level, traits, roster, unwraps=0, unique=False,
+                       sink=None, chunk_size=BATCH_SIZE,
+                       depth=PIPELINE_DEPTH, workers=None, snapshot=None):
+    return list(iter_pipeline(comps, level, traits, roster, unwraps, unique,
+                              sink, chunk_size, depth, workers, snapshot))
+
+
+def top_comps(comps, level, traits, k, roster, weights=None, cost_weight=0,
+              unwraps=0, unique=False):
+    start_time = time.time()
+
+    heap = []
+    kept = set()
+    all_comps = 0
+    for consumed, rows in roster.encode_batches(comps, level, unwraps,
+                                                unique=unique):
+        all_comps += consumed
+        if len(rows) == 0:
+            continue
+        rows = rows[roster.count_active(rows) >= traits]
+        scores = roster.score(rows, weights, cost_weight)
+        if len(heap) == k > 0:
+            # Only rows beating the current k-th score can enter, so ties
+            # keep the comps seen first.
+            rows, scores = rows[scores > heap[0][0]], \
+                scores[scores > heap[0][0]]
+        for score, mask in zip(scores.tolist(),
+                               roster.masks(rows).tolist()):
+            if mask in kept:
+                continue
+            entry = (score, -mask)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif heap and score > heap[0][0]:
+                kept.discard(-heapq.heapreplace(heap, entry)[1])
+            else:
+                continue
+            kept.add(mask)
+
+    end_time = time.time()
+    print('Kept ' + str(len(heap)) + ' best comps out of ' + str(all_comps) +
+          ':')
+    print_timer(end_time, start_time)
+
+    ranked = sorted(heap, reverse=True)
+    return [(score, roster.decode(-mask)) for score, mask in ranked]
+
+
+def rank_emblems(roster, level, min_traits, top=10, units=None):
+    start_time = time.time()
+
+    if units is None:
+        units = roster.get_units()
+    gains = roster.emblem_gains(level, min_traits, units)
+    ranked = sorted(((int(gains[u, j]), units[u], roster.get_traits()[j])
+                     for u, j in zip(*np.nonzero(gains))),
+                    key=lambda x: (-x[0], x[1].name, x[2].name))
+
+    end_time = time.time()
+    print('Ranked ' + str(len(ranked)) + ' emblem placements for level ' +
+          str(level) + ':')
+    for gain, unit, trait in ranked[:top]:
+        print('    ' + unit.get_name() + ' + ' + trait.get_name() + ': ' +
+              str(gain) + ' new comps')
+    print_timer(end_time, start_time)
+
+    return ranked
+
+
+def load_shard_context(roster, groups, forced):
+    # Workers given a snapshot path load the compiled arrays themselves
+    # instead of unpickling a Roster per worker.
+    global shard_context
+    if isinstance(roster, str):
+        roster = load_snapshot(roster).get_roster()
+    shard_context = (roster, groups, forced)
+
+
+def validate_shard(shard):
+    start_time = time.time()
+    roster, groups, forced = shard_context
+    # Combination shards carry the unit pool, hybrid shards the split.
+    lead, source, level, traits = shard
+
+    seen = set()
+    masks = []
+    candidates = 0
+    if groups is None:
+        pool = source
+        for tail in index_combinations(len(pool) - lead - 1,
+                                       level - len(forced) - 1):
+            rows = np.empty((len(tail), level), dtype=np.intp)
+            rows[:, 0] = pool[lead]
+            rows[:, 1:tail.shape[1] + 1] = pool[lead + 1:][tail]
+            rows[:, tail.shape[1] + 1:] = forced
+            candidates += len(rows)
+            passed = rows[roster.count_active(rows) >= traits]
+            masks.extend(roster.masks(passed).tolist())
+    else:
+        forced_mask = sum(1 << i for i in forced.tolist())
+        for mask in roster.hybrid_masks(source, groups, forced_mask, traits,
+                                        lead):
+            candidates += 1
+            masks.append(mask)
+    unique_masks = []
+    for mask in masks:
+        if mask not in seen:
+            seen.add(mask)
+            unique_masks.append(mask)
+
+    return candidates, unique_masks, time.time() - start_time
+
+
+def validate_parallel(level, traits, unit_pool, trait_pool, roster,
+                      split=None, force=[], workers=None, snapshot=None):
+    start_time = time.time()
+    if workers is None:
+        workers = os.cpu_count()
+
+    forced = np.array([roster.unit_index[unit] for unit in force],
+                      dtype=np.intp)
+    pool = np.array([roster.unit_index[unit] for unit in unit_pool
+                     if roster.unit_index[unit] not in forced],
+                    dtype=np.intp)
+    if split is None:
+        # Shard by leading unit: shard i holds every combination whose
+        # lowest pool position is i.
+        groups = None
+        shards = [(lead, pool, level, traits)
+                  for lead in range(len(pool) - (level - len(forced)) + 1)]
+        if len(forced) >= level:
+            shards = []
+    else:
+        groups = hybrid_groups(split, unit_pool, trait_pool, roster)
+        # Shard by the part placed in the first slot, which hybrid_masks()
+        # fills from the largest part size down.
+        leads = lead_count(split, groups)
+        step = max(1, -(-leads // (workers * SHARDS_PER_WORKER)))
+        shards = [(range(lead, lead + step), split, level, traits)
+                  for lead in range(0, leads, step)]
+    if workers == 1:
+        load_shard_context(roster, groups, forced)
+        outputs = list(map(validate_shard, shards))
+    else:
+        with ProcessPoolExecutor(workers, initializer=load_shard_context,
+                                 initargs=(snapshot or roster, groups,
+                                           forced)) as executor:
+            outputs = list(executor.map(validate_shard, shards))
+
     seen = set()
     unique_comps = []
     all_comps = 0
-    validated_comps = 0
-
-    for team in comps:
+    if split is None and len(forced) == level:
+        # The forced units are the whole comp, which no shard covers.
         all_comps += 1
-        flattened_team = team
-        for _ in range(unwraps):
-            flattened_team = flatten_once(flattened_team)
-        flattened_team = set(flattened_team)
-        if len(flattened_team) == level:
-            sorted_team_key = tuple(sorted((unit.cost, unit.name)
-                                           for unit in flattened_team))
-            if sorted_team_key not in seen:
-                active = check_active(flattened_team)
-                if len(active) >= traits:
-                    seen.add(sorted_team_key)
-                    unique_comps.append((flattened_team))
-                    validated_comps += 1
+        rows = forced[np.newaxis]
+        for mask in roster.masks(rows[roster.count_active(rows) >=
+                                      traits]).tolist():
+            seen.add(mask)
+            unique_comps.append(roster.decode(mask))
+    for shard, (candidates, masks, elapsed) in enumerate(outputs):
+        all_comps += candidates
+        print('    Shard ' + str(shard) + ': ' + str(len(masks)) +
+              ' of ' + str(candidates) + ' in ' + str(elapsed) + ' seconds')
+        for mask in masks:
+            if mask not in seen:
+                seen.add(mask)
+                unique_comps.append(roster.decode(mask))
 
     end_time = time.time()
-    print('Validated ' + str(validated_comps) + ' comps out of ' +
-          str(all_comps) + ':')
+    print('Validated ' + str(len(unique_comps)) + ' comps out of ' +
+          str(all_comps) + ' on ' + str(workers) + ' workers:')
     print_timer(end_time, start_time)
 
     return unique_comps
 
 
+def combination_chunks(n, k, chunk_size=CHUNK_SIZE):
+    # Lexicographic prefixes of index combinations, just long enough that
+    # no prefix has more than chunk_size completions. Chunk i is every
+    # combination starting with prefixes[i], so ids are the same every run.
+    width = 0
+    while width < k and math.comb(n - width, k - width) > chunk_size:
+        width += 1
+    return [prefix for prefix in itertools.combinations(range(n), width)
+            if width == 0 or prefix[-1] < n - k + width]
+
+
+def chunk_rows(n, k, prefix, batch_size=BATCH_SIZE):
+    after = prefix[-1] + 1 if prefix else 0
+    for tail in index_combinations(n - after, k - len(prefix), batch_size):
+        rows = np.empty((len(tail), k), dtype=np.intp)
+        rows[:, :len(prefix)] = prefix
+        rows[:, len(prefix):] = tail + after
+        yield rows
+
+
+def id_ranges(ids):
+    ranges = []
+    for i in sorted(ids):
+        if ranges and ranges[-1][1] == i:
+            ranges[-1][1] = i + 1
+        else:
+            ranges.append([i, i + 1])
+    return ranges
+
+
+def load_checkpoint(path, key):
+    progress = os.path.join(path, 'progress.json')
+    if not os.path.exists(progress):
+        return {'key': key, 'done': [], 'candidates': 0, 'comps': 0}
+    with open(progress) as file:
+        state = json.load(file)
+    if state['key'] != key:
+        raise ValueError('Checkpoint in ' + path + ' belongs to a different '
+                         'enumeration.')
+    return state
+
+
+def save_checkpoint(path, state):
+    progress = os.path.join(path, 'progress.json')
+    partial = progress + '.' + str(os.getpid()) + '.tmp'
+    with open(partial, 'w') as file:
+        json.dump(state, file)
+    os.replace(partial, progress)
+
+
+def validate_checkpointed(level, traits, unit_pool, roster, path,
+                          chunks=None, interval=CHECKPOINT_SECONDS,
+                          chunk_size=CHUNK_SIZE):
+    start_time = time.time()
+
+    pool = np.array([roster.unit_index[unit] for unit in unit_pool],
+                    dtype=np.intp)
+    prefixes = combination_chunks(len(pool), level, chunk_size)
+    if chunks is None:
+        chunks = range(len(prefixes))
+    key = hashlib.sha1((roster.fingerprint() + '|' +
+                        ','.join(unit.name for unit in unit_pool) + '|' +
+                        str(level) + '|' + str(traits) + '|' +
+                        str(chunk_size)).encode()).hexdigest()
+    os.makedirs(path, exist_ok=True)
+    state = load_checkpoint(path, key)
+    done = set(i for start, stop in state['done'] for i in range(start, stop))
+    # comps.bin holds the masks of checkpointed chunks in order. Anything
+    # past the recorded length came from chunks that never reached a
+    # checkpoint, and those chunks are about to be redone.
+    results = os.path.join(path, 'comps.bin')
+    with open(results, 'ab') as file:
+        file.truncate(state['comps'] * 8)
+
+    def size(chunk):
+        prefix = prefixes[chunk]
+        after = prefix[-1] + 1 if prefix else 0
+        return math.comb(len(pool) - after, level - len(prefix))
+
+    todo = [chunk for chunk in chunks if chunk not in done]
+    remaining = sum(size(chunk) for chunk in todo)
+    checked = 0
+    saved_time = time.time()
+    with open(results, 'ab') as file:
+        for position, chunk in enumerate(todo):
+            for rows in chunk_rows(len(pool), level, prefixes[chunk]):
+                rows = pool[rows]
+                masks = roster.masks(rows[roster.count_active(rows) >= traits])
+                file.write(masks.astype('<u8').tobytes())
+                state['comps'] += len(masks)
+            checked += size(chunk)
+            state['candidates'] += size(chunk)
+            done.add(chunk)
+            if time.time() - saved_time >= interval or \
+                    position == len(todo) - 1:
+                file.flush()
+                os.fsync(file.fileno())
+                state['done'] = id_ranges(done)
+                save_checkpoint(path, state)
+                saved_time = time.time()
+                rate = checked / max(saved_time - start_time, 1e-9)
+                print('    Chunk ' + str(position + 1) + ' of ' +
+                      str(len(todo)) + ': ' + str(checked) + ' of ' +
+                      str(remaining) + ' candidates at ' + str(round(rate)) +
+                      ' per second, ETA ' +
+                      str(round((remaining - checked) / max(rate, 1e-9))) +
+                      ' seconds')
+
+    masks = np.zeros(0, dtype=np.uint64)
+    if state['comps'] > 0:
+        masks = np.memmap(results, dtype='<u8', mode='r',
+                          shape=(state['comps'],))
+
+    end_time = time.time()
+    print('Validated ' + str(state['comps']) + ' comps out of ' +
+          str(state['candidates']) + ' in ' + str(len(done)) + ' of ' +
+          str(len(prefixes)) + ' chunks:')
+    print_timer(end_time, start_time)
+
+    return masks
+
+
+class SplitPlanner:
+    def __init__(self, unit_pool, trait_pool, roster=None,
+                 sample_seconds=PLAN_SECONDS, seed=0):
+        self.unit_pool = list(unit_pool)
+        self.trait_pool = trait_pool
+        if roster is None:
+            roster = Roster(unit_pool, trait_pool)
+        self.roster = roster
+        self.sample_seconds = sample_seconds
+        self.seed = seed
+        self.plans = {}
+
+    def get_plans(self, level, traits):
+        if (level, traits) not in self.plans:
+            self.plans[level, traits] = sorted(
+                [self.estimate(split, level, traits)
+                 for split in split_partitions(level)] +
+                [self.estimate('join', level, traits)],
+                key=lambda plan: plan['cost'])
+        return self.plans[level, traits]
+
+    def choose(self, level, traits):
+        # Hybrid splits only find comps their parts decompose into, so only
+        # plans that find every comp compete.
+        return [plan for plan in self.get_plans(level, traits)
+                if plan['complete']][0]
+
+    def estimate(self, split, level, traits):
+        # Generation is the time to load (or build and cache) the branch
+        # masks a split needs. Enumeration is timed on a shuffled sample of
+        # the work and scaled up to all of it.
+        rng = random.Random(self.seed)
+        roster = self.roster
+        pool = np.array([roster.unit_index[unit] for unit in self.unit_pool],
+                        dtype=np.intp)
+        start_time = time.time()
+        if split == 'join':
+            left, right, shared = roster.partition(pool.tolist())
+            sizes = range(max(0, level - len(right)),
+                          min(level, len(left)) + 1)
+            halves = sum(math.comb(len(left), size) +
+                         math.comb(len(right), level - size)
+                         for size in sizes)
+            sample = min(level, len(left), 4)
+            roster.half_buckets(left, sample, shared)
+            validation = (time.time() - start_time) * halves / \
+                max(1, math.comb(len(left), sample))
+            return {'split': split, 'candidates': halves, 'generation': 0.0,
+                    'validation': validation, 'cost': validation,
+                    'bound': False, 'complete': True}
+        if split == [1] * level:
+            candidates = math.comb(len(pool), level)
+            done = 0
+            for rows in index_combinations(len(pool), level):
+                rows = pool[rows]
+                roster.masks(rows[roster.count_active(rows) >= traits])
+                done += len(rows)
+                if time.time() - start_time > self.sample_seconds:
+                    break
+            validation = (time.time() - start_time) * candidates / \
+                max(1, done)
+            return {'split': split, 'candidates': candidates,
+                    'generation': 0.0, 'validation': validation,
+                    'cost': validation, 'bound': False, 'complete': True}
+        groups = hybrid_groups(split, self.unit_pool, self.trait_pool, roster)
+        generation = time.time() - start_time
+        leads = lead_count(split, groups)
+        step = max(1, -(-leads // 1024))
+        blocks = [range(lead, min(lead + step, leads))
+                  for lead in range(0, leads, step)]
+        rng.shuffle(blocks)
+        # A full run sets up hybrid_masks() once, the sample once per block.
+        start_time = time.time()
+        for mask in roster.hybrid_masks(split, groups, 0, traits, range(0)):
+            pass
+        setup = time.time() - start_time
+        start_time = time.time()
+        deadline = start_time + self.sample_seconds
+        calls = 0
+        done = 0
+        found = 0
+        for block in blocks:
+            calls += 1
+            masks = list(roster.hybrid_masks(split, groups, 0, traits, block,
+                                             deadline))
+            if time.time() > deadline:
+                break
+            found += len(masks)
+            done += 1
+        # When not even one block finishes in time, the whole run takes at
+        # least that long for every block.
+        elapsed = max(0.0, time.time() - start_time - calls * setup)
+        scale = len(blocks) / max(1, done)
+        validation = setup + elapsed * scale
+        candidates = math.prod(
+            math.comb(len(group), split.count(size))
+            for group, size in zip(groups, [4, 3, 2, 1]))
+        return {'split': split, 'candidates': candidates,
+                'found': round(found * scale), 'generation': generation,
+                'validation': validation, 'cost': generation + validation,
+                'bound': done == 0, 'complete': False}
+
+    def explain(self, level, traits):
+        lines = ['Plans for comps of length ' + str(level) + ' with ' +
+                 str(traits) + ' or more traits, cheapest first:']
+        for plan in self.get_plans(level, traits):
+            line = '    ' + str(plan['split']) + ': ' + \
+                str(plan['candidates']) + ' candidates, ' + \
+                str(round(plan['generation'], 3)) + \
+                ' seconds generation + ' + \
+                ('at least ' if plan['bound'] else '') + \
+                str(round(plan['validation'], 3)) + ' seconds enumeration'
+            if not plan['complete']:
+                line += ', about ' + str(plan['found']) + ' comps found; ' \
+                    'skipped, misses comps the split cannot build'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def run(self, level, traits):
+        plan = self.choose(level, traits)
+        print(self.explain(level, traits))
+        if plan['split'] == 'join':
+            comps = get_joined(level, self.unit_pool, self.trait_pool, traits,
+                               roster=self.roster)
+        else:
+            comps = get_combinations(level, self.unit_pool,
+                                     roster=self.roster)
+        return validate(comps, level, traits, roster=self.roster,
+                        unique=True)
+
+
+def build_roster(path=SET_PATH):
+    return build_pools(load_definition(path),
+                       lambda trait: Trait(trait['name'], trait['tiers']),
+                       lambda unit, traits: Node(unit['name'], traits,
+                                                 unit['cost']))
+
+
+def compile_roster(path=SET_PATH, cache_dir=ROSTER_CACHE):
+    # Compile a set file once into an uncompressed .npz named by the hash
+    # of its bytes and of the snapshot layout: the format version and the
+    # Roster state it stores. Editing either simply misses the cache.
+    layout = str(SNAPSHOT_VERSION) + '|' + \
+        ','.join(sorted(Roster([]).__getstate__())) + '|'
+    with open(path, 'rb') as file:
+        key = hashlib.sha1(layout.encode() + file.read()).hexdigest()[:16]
+    snapshot = os.path.join(cache_dir, 'roster_' + key + '.npz')
+    if os.path.exists(snapshot):
+        return snapshot
+    unit_pool, trait_pool = build_roster(path)
+    graph = build_graph(unit_pool)
+    roster = Roster(unit_pool, trait_pool)
+    classes = np.zeros(len(unit_pool), dtype=np.intp)
+    for label, members in enumerate(roster.classes()):
+        classes[members] = label
+    arrays = {'roster_' + name: np.asarray(value)
+              for name, value in roster.__getstate__().items()}
+    arrays['unit_names'] = np.array([unit.name for unit in unit_pool])
+    arrays['trait_names'] = np.array([trait.name
+                                      for trait in roster.get_traits()])
+    arrays['neighbor_masks'] = np.array(
+        [graph.get_neighbor_mask(unit) for unit in unit_pool],
+        dtype=np.uint64)
+    arrays['trait_masks'] = np.array(
+        [graph.get_trait_mask(trait) for trait in roster.get_traits()],
+        dtype=np.uint64)
+    arrays['classes'] = classes
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = snapshot + '.' + str(os.getpid()) + '.tmp'
+    with open(partial, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(partial, snapshot)
+    return snapshot
+
+
+def load_snapshot(path):
+    with np.load(path) as arrays:
+        return RosterSnapshot({name: arrays[name] for name in arrays.files})
+
+
 def main():
-    anima_squad = Trait('anima_squad', [3, 5, 7, 10])
-    boombot = Trait('boombot', [2, 4, 6])
-    cyberboss = Trait('cyberboss', [2, 3, 4])
-    divinicorp = Trait('divinicorp', [1, 2, 3, 4, 5, 6, 7])
-    exotech = Trait('exotech', [3, 5, 7, 10])
-    nitro = Trait('nitro', [3, 4])
-    golden_ox = Trait('golden_ox', [2, 4, 6])
-    syndicate = Trait('syndicate', [3, 5, 7])
-    street_demon = Trait('street_demon', [3, 5, 7, 10])
-    cypher = Trait('cypher', [3, 4, 5])
-    bastion = Trait('bastion', [2, 4, 6])
-    bruiser = Trait('bruiser', [2, 4, 6])
-    strategist = Trait('strategist', [2, 3, 4, 5])
-    executioner = Trait('executioner', [2, 3, 4, 5])
-    marksman = Trait('marksman', [2, 4])
-    slayer = Trait('slayer', [2, 4, 6])
-    amp = Trait('amp', [2, 3, 4, 5])
-    rapidfire = Trait('rapidfire', [2, 4, 6])
-    techie = Trait('techie', [2, 4, 6, 8])
-    dynamo = Trait('dynamo', [2, 3, 4])
-    vanguard = Trait('vanguard', [2, 4, 6])
-
-    trait_pool = [anima_squad, boombot, cyberboss, divinicorp, exotech,
-                  nitro, golden_ox, syndicate, street_demon, cypher, bastion,
-                  bruiser, strategist, executioner, marksman, slayer, amp,
-                  rapidfire, techie, dynamo, vanguard]
-
-    alistar = Node('alistar', [golden_ox, bruiser], 1)
-    annie = Node('annie', [golden_ox, amp], 4)
-    aphelios = Node('aphelios', [golden_ox, marksman], 4)
-    aurora = Node('aurora', [anima_squad, dynamo], 5)
-    brand = Node('brand', [street_demon, techie], 4)
-    braum = Node('braum', [syndicate, vanguard], 3)
-    chogath = Node('chogath', [boombot, bruiser], 4)
-    darius = Node('darius', [syndicate, bruiser], 2)
-    draven = Node('draven', [cypher, rapidfire], 3)
-    dr_mundo = Node('dr_mundo', [street_demon, bruiser, slayer], 1)
-    ekko = Node('ekko', [street_demon, strategist], 2)
-    elise = Node('elise', [nitro, dynamo], 3)
-    fiddlesticks = Node('fiddlesticks', [boombot, techie], 3)
-    galio = Node('galio', [cypher, bastion], 3)
-    garen = Node('garen', [], 5)
-    gragas = Node('gragas', [divinicorp, bruiser], 3)
-    graves = Node('graves', [golden_ox, executioner], 2)
-    illaoi = Node('illaoi', [anima_squad, bastion], 2)
-    jarvan = Node('jarvan', [golden_ox, vanguard, slayer], 3)
-    jax = Node('jax', [exotech, bastion], 1)
-    jhin = Node('jhin', [exotech, marksman, dynamo], 2)
-    jinx = Node('jinx', [street_demon, marksman], 3)
-    kindred = Node('kindred', [nitro, rapidfire, marksman], 1)
-    kobuko = Node('kobuko', [cyberboss, bruiser], 5)
-    kogmaw = Node('kogmaw', [boombot, rapidfire], 1)
-    leblanc = Node('leblanc', [cypher, strategist], 2)
-    leona = Node('leona', [anima_squad, vanguard], 4)
-    miss_fortune = Node('miss_fortune', [syndicate, dynamo], 4)
-    mordekaiser = Node('mordekaiser', [exotech, bruiser, techie], 3)
-    morgana = Node('morgana', [divinicorp, dynamo], 1)
-    naafiri = Node('naafiri', [exotech, amp], 2)
-    neeko = Node('neeko', [street_demon, strategist], 4)
-    nidalee = Node('nidalee', [nitro, amp], 1)
-    poppy = Node('poppy', [cyberboss, bastion], 1)
-    renekton = Node('renekton', [divinicorp, bastion], 5)
-    rengar = Node('rengar', [street_demon, executioner], 3)
-    rhaast = Node('rhaast', [divinicorp, vanguard], 2)
-    samira = Node('samira', [street_demon, amp], 5)
-    sejuani = Node('sejuani', [exotech, bastion], 4)
-    senna = Node('senna', [divinicorp, slayer], 3)
-    seraphine = Node('seraphine', [anima_squad, techie], 1)
-    shaco = Node('shaco', [syndicate, slayer], 1)
-    shyvana = Node('shyvana', [nitro, bastion, techie], 2)
-    skarner = Node('skarner', [boombot, vanguard], 2)
-    sylas = Node('sylas', [anima_squad, vanguard], 1)
-    twisted_fate = Node('twisted_fate', [syndicate, rapidfire], 2)
-    urgot = Node('urgot', [boombot, executioner], 5)
-    varus = Node('varus', [exotech, executioner], 3)
-    vayne = Node('vayne', [anima_squad, slayer], 2)
-    veigar = Node('veigar', [cyberboss, techie], 2)
-    vex = Node('vex', [divinicorp, executioner], 4)
-    vi = Node('vi', [cypher, vanguard], 1)
-    viego = Node('viego', [golden_ox, techie], 5)
-    xayah = Node('xayah', [anima_squad, marksman], 4)
-    yuumi = Node('yuumi', [anima_squad, amp, strategist], 3)
-    zac = Node('zac', [], 5)
-    zed = Node('zed', [cypher, slayer], 4)
-    zeri = Node('zeri', [exotech, rapidfire], 4)
-    ziggs = Node('ziggs', [cyberboss, strategist], 4)
-    zyra = Node('zyra', [street_demon, techie], 1)
-
-    unit_pool = [alistar, annie, aphelios, aurora, brand, braum, chogath,
-                 darius, draven, dr_mundo, ekko, elise, fiddlesticks, galio,
-                 garen, gragas, graves, illaoi, jarvan, jax, jhin, jinx,
-                 kindred, kobuko, kogmaw, leblanc, leona, miss_fortune,
-                 mordekaiser, morgana, naafiri, neeko, nidalee, poppy,
-                 renekton, rengar, rhaast, samira, sejuani, senna, seraphine,
-                 shaco, shyvana, skarner, sylas, twisted_fate, urgot, varus,
-                 vayne, veigar, vex, vi, viego, xayah, yuumi, zac, zed, zeri,
-                 ziggs, zyra]
-
-    build_graph(unit_pool)
+    unit_pool, trait_pool = build_roster()
+    graph = build_graph(unit_pool)
+    roster = Roster(unit_pool, trait_pool)
+    print('Compiled graph of ' + str(len(graph.get_units())) + ' units and ' +
+          str(int(graph.get_adjacency().sum()) // 2) + ' edges')
 
     """
     units = [tuple([unit]) for unit in unit_pool]
-    branches_2 = iterate_seeded_growth(units)
-    branches_3 = iterate_seeded_growth(branches_2)
-    branches_4 = iterate_seeded_growth(branches_3)
+    branches_2 = seeded_growth(units)
+    branches_3 = seeded_growth(branches_2)
+    branches_4 = seeded_growth(branches_3)
 
     print('branches_2: ' + str(len(branches_2)))
     for branch in branches_2:
@@ -374,7 +2752,8 @@ def main():
     print('filtered branches_4: ' + str(len(branches_4)))
     """
 
-    validate(get_hybrid([2, 2, 1], unit_pool, trait_pool, []), 5, 5, 2)
+    validate(get_hybrid([2, 2, 1], unit_pool, trait_pool, roster=roster), 5,
+             5, 2, roster=roster)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,23 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+
 import networkx as nx
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
 import matplotlib.pyplot as plt
 
+from roster_loader import build_pools, load_definition
+
+LAYOUT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '.layout_cache')
+RENDERER = None
+
 
 class Node:
     def __init__(self, name, traits, cost):
@@ -77,13 +94,20 @@ class GraphVisualization:
         self.nodes.append(a)
         self.disconnected_pos[a] = pos
 
+    def layout(self, cache_dir=LAYOUT_CACHE):
+        named = cached_layout([(a.get_name(), b.get_name())
+                               for a, b in self.edges],
+                              {node.get_name(): self.disconnected_pos[node]
+                               for node in self.nodes}, cache_dir)
+        units = set(node for edge in self.edges for node in edge)
+        units.update(self.nodes)
+        return {node: named[node.get_name()] for node in units}
+
     def visualize(self):
         G = nx.Graph()
         G.add_edges_from(self.edges)
-        pos = nx.kamada_kawai_layout(G)
         G.add_nodes_from(self.nodes)
-        for node in self.nodes:
-            pos[node] = self.disconnected_pos[node]
+        pos = self.layout()
         colormap = []
         labels = {}
         for node in G:
@@ -94,6 +118,178 @@ class GraphVisualization:
         plt.show()
 
 
+def cached_layout(edges, fixed={}, cache_dir=LAYOUT_CACHE):
+    # Kamada-Kawai positions by unit name, computed once per edge set and
+    # kept on disk. fixed places units that have no edges.
+    key = hashlib.sha1(json.dumps([sorted(sorted(edge) for edge in edges),
+                                   sorted(fixed.items())]).encode())
+    path = os.path.join(cache_dir, 'layout_' + key.hexdigest()[:16] +
+                        '.json')
+    if os.path.exists(path):
+        with open(path) as file:
+            return json.load(file)
+    G = nx.Graph()
+    G.add_edges_from(edges)
+    positions = {name: [float(x), float(y)]
+                 for name, (x, y) in nx.kamada_kawai_layout(G).items()}
+    for name, position in fixed.items():
+        positions[name] = [float(value) for value in position]
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = path + '.' + str(os.getpid()) + '.tmp'
+    with open(partial, 'w') as file:
+        json.dump(positions, file)
+    os.replace(partial, path)
+    return positions
+
+
+def loner_positions(unit_pool):
+    # Units without neighbors have no edges and so no layout position;
+    # pin them down the right side.
+    loners = [unit for unit in unit_pool if len(unit.get_neighbors()) == 0]
+    return {unit.get_name(): [0.75, 0.75 - 1.5 * i / max(1, len(loners) - 1)]
+            for i, unit in enumerate(loners)}
+
+
+def graph_edges(unit_pool):
+    # Each neighboring pair once, in unit_pool order.
+    edges = []
+    plotted = set()
+    for unit in unit_pool:
+        for neighbor in unit.get_neighbors():
+            if neighbor not in plotted:
+                edges.append((unit, neighbor))
+        plotted.add(unit)
+    return edges
+
+
+class BatchRenderer:
+    def __init__(self, edges, positions, colors, size=8, dpi=100):
+        # Draws the whole graph once on an Agg canvas and keeps that bitmap;
+        # each image restores it and draws only the highlighted artists.
+        self.names = sorted(positions)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.points = np.array([positions[name] for name in self.names])
+        self.edges = np.array(sorted(set(
+            tuple(sorted((self.index[a], self.index[b]))) for a, b in edges
+            if a != b)), dtype=np.intp).reshape(-1, 2)
+        self.figure = Figure(figsize=(size, size), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_axes([0, 0, 1, 1])
+        self.axes.set_axis_off()
+        low, high = self.points.min(axis=0), self.points.max(axis=0)
+        margin = 0.08 * (high - low).max()
+        self.axes.set_xlim(low[0] - margin, high[0] + margin)
+        self.axes.set_ylim(low[1] - margin, high[1] + margin)
+        self.canvas.draw()
+        self.blank = self.canvas.copy_from_bbox(self.figure.bbox)
+
+        self.base = [
+            self.axes.add_collection(LineCollection(
+                self.points[self.edges], colors='#d0d0d0', linewidths=0.6,
+                zorder=1)),
+            self.axes.scatter(self.points[:, 0], self.points[:, 1], s=160,
+                              c=[colors[name] for name in self.names],
+                              alpha=0.35, linewidths=0, zorder=2)]
+        self.labels = [self.axes.text(x, y, name, fontsize=6, ha='center',
+                                      va='center', zorder=4)
+                       for name, (x, y) in zip(self.names, self.points)]
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+
+        self.colors = np.array([to_rgba(colors[name])
+                                for name in self.names])
+        self.lines = LineCollection([], colors='#303030', linewidths=1.4,
+                                    zorder=1, animated=True)
+        self.added = LineCollection([], colors='#e0301e', linewidths=1.8,
+                                    zorder=1, animated=True)
+        self.nodes = self.axes.scatter([], [], s=420, linewidths=1.5,
+                                       edgecolors='black', zorder=3,
+                                       animated=True)
+        self.title = self.axes.text(0.02, 0.98, '', fontsize=10, va='top',
+                                    transform=self.axes.transAxes,
+                                    animated=True)
+        self.axes.add_collection(self.lines)
+        self.axes.add_collection(self.added)
+
+    def highlight(self, names, added, title):
+        chosen = np.zeros(len(self.names), dtype=bool)
+        chosen[[self.index[name] for name in names]] = True
+        inside = chosen[self.edges].all(axis=1)
+        self.lines.set_segments(self.points[self.edges[inside]])
+        self.added.set_segments([self.points[[self.index[a], self.index[b]]]
+                                 for a, b in added])
+        self.nodes.set_offsets(self.points[chosen].reshape(-1, 2))
+        self.nodes.set_facecolor(self.colors[chosen])
+        self.title.set_text(title)
+        return chosen
+
+    def render(self, path, names=(), added=(), title='', subgraph=False):
+        # PNGs are blitted over the cached bitmap; other formats (SVG, PDF)
+        # need the vector artists, so they go through savefig().
+        chosen = self.highlight(names, added, title)
+        artists = [self.lines, self.added, self.nodes, self.title]
+        if not path.lower().endswith('.png'):
+            for label, shown in zip(self.labels, chosen):
+                label.set_visible(shown or not subgraph)
+            for artist in self.base:
+                artist.set_visible(not subgraph)
+            for artist in artists:
+                artist.set_animated(False)
+            self.figure.savefig(path)
+            for artist in artists:
+                artist.set_animated(True)
+            for artist in self.base + self.labels:
+                artist.set_visible(True)
+            return path
+        if subgraph:
+            self.canvas.restore_region(self.blank)
+        else:
+            self.canvas.restore_region(self.background)
+        # Highlighted nodes cover their labels in the bitmap; redraw them.
+        artists += [label for label, shown in zip(self.labels, chosen)
+                    if shown]
+        for artist in artists:
+            self.axes.draw_artist(artist)
+        # Opaque RGB at zlib's fastest level: encoding at the default level
+        # costs several times more than drawing.
+        imsave(path, np.asarray(self.canvas.buffer_rgba())[:, :, :3],
+               pil_kwargs={'compress_level': 1})
+        return path
+
+
+def load_renderer(edges, positions, colors, size, dpi):
+    global RENDERER
+    RENDERER = BatchRenderer(edges, positions, colors, size, dpi)
+
+
+def render_job(job):
+    return RENDERER.render(**job)
+
+
+def render_batch(jobs, unit_pool, fixed={}, workers=None, size=8, dpi=100,
+                 cache_dir=LAYOUT_CACHE):
+    # jobs are render() keyword dicts: path, names, added, title, subgraph.
+    # The layout comes from the cache and each worker draws the base graph
+    # once, so an image costs one blit and one PNG encode. fixed overrides
+    # the default spots of units without edges.
+    if workers is None:
+        workers = os.cpu_count()
+    edges = [(a.get_name(), b.get_name()) for a, b in graph_edges(unit_pool)]
+    fixed = dict(loner_positions(unit_pool), **fixed)
+    positions = cached_layout(edges, fixed, cache_dir)
+    colors = {unit.get_name(): unit.get_color() for unit in unit_pool}
+    positions = {name: positions[name] for name in colors}
+    context = (edges, positions, colors, size, dpi)
+    if workers == 1:
+        load_renderer(*context)
+        return [render_job(job) for job in jobs]
+    with ProcessPoolExecutor(workers, initializer=load_renderer,
+                             initargs=context) as executor:
+        return list(executor.map(render_job, jobs,
+                                 chunksize=max(1, len(jobs) //
+                                               (workers * 4))))
+
+
 def build_graph(unit_pool):
     for unit in unit_pool:
         unit.set_neighbors()
@@ -106,117 +302,22 @@ def add_emblem(unit, trait, unit_pool):
 
 
 def main():
-    anima_squad = Trait('anima_squad', [3, 5, 7, 10], '#ffaaf7')
-    boombot = Trait('boombot', [2, 4, 6], "#ad620c")
-    cyberboss = Trait('cyberboss', [2, 3, 4], "#5964f3")
-    divinicorp = Trait('divinicorp', [1, 2, 3, 4, 5, 6, 7], "#8ed5ff")
-    exotech = Trait('exotech', [3, 5, 7, 10], "#676A77")
-    nitro = Trait('nitro', [3, 4], "#f03629")
-    golden_ox = Trait('golden_ox', [2, 4, 6], "#ffd000")
-    syndicate = Trait('syndicate', [3, 5, 7], "#8547cc")
-    street_demon = Trait('street_demon', [3, 5, 7, 10], "#00ffc8")
-    cypher = Trait('cypher', [3, 4, 5], "#66ff00")
-    bastion = Trait('bastion', [2, 4, 6])
-    bruiser = Trait('bruiser', [2, 4, 6])
-    strategist = Trait('strategist', [2, 3, 4, 5])
-    executioner = Trait('executioner', [2, 3, 4, 5])
-    marksman = Trait('marksman', [2, 4])
-    slayer = Trait('slayer', [2, 4, 6])
-    amp = Trait('amp', [2, 3, 4, 5])
-    rapidfire = Trait('rapidfire', [2, 4, 6])
-    techie = Trait('techie', [2, 4, 6, 8])
-    dynamo = Trait('dynamo', [2, 3, 4])
-    vanguard = Trait('vanguard', [2, 4, 6])
-
-    trait_pool = [anima_squad, boombot, cyberboss, divinicorp, exotech, nitro,
-                  golden_ox, syndicate, street_demon, cypher, bastion,
-                  bruiser, strategist, executioner, marksman, slayer, amp,
-                  rapidfire, techie, dynamo, vanguard]
-
-    alistar = Node('Alistar', [golden_ox, bruiser], 1)
-    annie = Node('Annie', [golden_ox, amp], 4)
-    aphelios = Node('Aphelios', [golden_ox, marksman], 4)
-    aurora = Node('Aurora', [anima_squad, dynamo], 5)
-    brand = Node('Brand', [street_demon, techie], 4)
-    braum = Node('Braum', [syndicate, vanguard], 3)
-    chogath = Node('Chogath', [boombot, bruiser], 4)
-    darius = Node('Darius', [syndicate, bruiser], 2)
-    draven = Node('Draven', [cypher, rapidfire], 3)
-    dr_mundo = Node('Dr. Mundo', [street_demon, bruiser, slayer], 1)
-    ekko = Node('Ekko', [street_demon, strategist], 2)
-    elise = Node('Elise', [nitro, dynamo], 3)
-    fiddlesticks = Node('Fiddlesticks', [boombot, techie], 3)
-    galio = Node('Galio', [cypher, bastion], 3)
-    garen = Node('Garen', [], 5)
-    gragas = Node('Gragas', [divinicorp, bruiser], 3)
-    graves = Node('Graves', [golden_ox, executioner], 2)
-    illaoi = Node('Illaoi', [anima_squad, bastion], 2)
-    jarvan = Node('Jarvan IV', [golden_ox, vanguard, slayer], 3)
-    jax = Node('Jax', [exotech, bastion], 1)
-    jhin = Node('Jhin', [exotech, marksman, dynamo], 2)
-    jinx = Node('Jinx', [street_demon, marksman], 3)
-    kindred = Node('Kindred', [nitro, rapidfire, marksman], 1)
-    kobuko = Node('Kobuko', [cyberboss, bruiser], 5)
-    kogmaw = Node("Kog'Maw", [boombot, rapidfire], 1)
-    leblanc = Node('LeBlanc', [cypher, strategist], 2)
-    leona = Node('Leona', [anima_squad, vanguard], 4)
-    miss_fortune = Node('Miss Fortune', [syndicate, dynamo], 4)
-    mordekaiser = Node('Mordekaiser', [exotech, bruiser, techie], 3)
-    morgana = Node('Morgana', [divinicorp, dynamo], 1)
-    naafiri = Node('Naafiri', [exotech, amp], 2)
-    neeko = Node('Neeko', [street_demon, strategist], 4)
-    nidalee = Node('Nidalee', [nitro, amp], 1)
-    poppy = Node('Poppy', [cyberboss, bastion], 1)
-    renekton = Node('Renekton', [divinicorp, bastion], 5)
-    rengar = Node('Rengar', [street_demon, executioner], 3)
-    rhaast = Node('Rhaast', [divinicorp, vanguard], 2)
-    samira = Node('Samira', [street_demon, amp], 5)
-    sejuani = Node('Sejuani', [exotech, bastion], 4)
-    senna = Node('Senna', [divinicorp, slayer], 3)
-    seraphine = Node('Seraphine', [anima_squad, techie], 1)
-    shaco = Node('Shaco', [syndicate, slayer], 1)
-    shyvana = Node('Shyvana', [nitro, bastion, techie], 2)
-    skarner = Node('Skarner', [boombot, vanguard], 2)
-    sylas = Node('Sylas', [anima_squad, vanguard], 1)
-    twisted_fate = Node('Twisted Fate', [syndicate, rapidfire], 2)
-    urgot = Node('Urgot', [boombot, executioner], 5)
-    varus = Node('Varus', [exotech, executioner], 3)
-    vayne = Node('Vayne', [anima_squad, slayer], 2)
-    veigar = Node('Veigar', [cyberboss, techie], 2)
-    vex = Node('Vex', [divinicorp, executioner], 4)
-    vi = Node('Vi', [cypher, vanguard], 1)
-    viego = Node('Viego', [golden_ox, techie], 5)
-    xayah = Node('Xayah', [anima_squad, marksman], 4)
-    yuumi = Node('Yuumi', [anima_squad, amp, strategist], 3)
-    zac = Node('Zac', [], 5)
-    zed = Node('Zed', [cypher, slayer], 4)
-    zeri = Node('Zeri', [exotech, rapidfire], 4)
-    ziggs = Node('Ziggs', [cyberboss, strategist], 4)
-    zyra = Node('Zyra', [street_demon, techie], 1)
-
-    unit_pool = [alistar, annie, aphelios, aurora, brand, braum, chogath,
-                 darius, draven, dr_mundo, ekko, elise, fiddlesticks, galio,
-                 garen, gragas, graves, illaoi, jarvan, jax, jhin, jinx,
-                 kindred, kobuko, kogmaw, leblanc, leona, miss_fortune,
-                 mordekaiser, morgana, naafiri, neeko, nidalee, poppy,
-                 renekton, rengar, rhaast, samira, sejuani, senna, seraphine,
-                 shaco, shyvana, skarner, sylas, twisted_fate, urgot, varus,
-                 vayne, veigar, vex, vi, viego, xayah, yuumi, zac, zed, zeri,
-                 ziggs, zyra]
+    unit_pool, trait_pool = build_pools(
+        load_definition(),
+        lambda trait: Trait(trait['name'], trait['tiers'],
+                            trait.get('color', '#a2a2a2')),
+        lambda unit, traits: Node(unit.get('display', unit['name']), traits,
+                                  unit['cost']))
 
     build_graph(unit_pool)
 
     unit_graph = GraphVisualization()
-    plotted = []
+    for unit, neighbor in graph_edges(unit_pool):
+        unit_graph.addEdge(unit, neighbor)
+    positions = loner_positions(unit_pool)
     for unit in unit_pool:
-        for neighbor in unit.get_neighbors():
-            if neighbor not in plotted:
-                unit_graph.addEdge(unit, neighbor)
-        if unit is garen:
-            unit_graph.addNode(unit, [0.75, 0.75])
-        if unit is zac:
-            unit_graph.addNode(unit, [0.75, -0.75])
-        plotted.append(unit)
+        if unit.get_name() in positions:
+            unit_graph.addNode(unit, positions[unit.get_name()])
     unit_graph.visualize()
 
 
@@ -0,0 +1,69 @@
+import json
+import os
+
+SET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'roster.json')
+
+
+def load_definition(path=SET_PATH):
+    # A set file lists traits with ascending tiers and units with a cost
+    # and the names of their traits; anything else is rejected up front.
+    with open(path) as file:
+        definition = json.load(file)
+    if not isinstance(definition, dict) or \
+            not isinstance(definition.get('traits'), list) or \
+            not isinstance(definition.get('units'), list):
+        raise ValueError(path + ' needs "traits" and "units" lists.')
+
+    traits = set()
+    for trait in definition['traits']:
+        name = trait.get('name') if isinstance(trait, dict) else None
+        if not isinstance(name, str) or name in traits:
+            raise ValueError('Missing or duplicate trait name ' + repr(name) +
+                             ' in ' + path)
+        tiers = trait.get('tiers')
+        if not isinstance(tiers, list) or len(tiers) == 0 or \
+                not all(isinstance(tier, int) and tier > 0
+                        for tier in tiers) or \
+                any(low >= high for low, high in zip(tiers, tiers[1:])):
+            raise ValueError('Trait ' + name + ' needs ascending positive '
+                             'tiers in ' + path)
+        traits.add(name)
+
+    units = set()
+    for unit in definition['units']:
+        name = unit.get('name') if isinstance(unit, dict) else None
+        if not isinstance(name, str) or name in units:
+            raise ValueError('Missing or duplicate unit name ' + repr(name) +
+                             ' in ' + path)
+        cost = unit.get('cost')
+        if not isinstance(cost, int) or cost < 1:
+            raise ValueError('Unit ' + name + ' needs a positive integer '
+                             'cost in ' + path)
+        if not isinstance(unit.get('traits', []), list):
+            raise ValueError('Unit ' + name + ' needs a list of traits in ' +
+                             path)
+        unknown = [trait for trait in unit.get('traits', [])
+                   if trait not in traits]
+        if unknown:
+            raise ValueError('Unit ' + name + ' has unknown traits ' +
+                             repr(unknown) + ' in ' + path)
+        units.add(name)
+    if len(units) > 64:
+        raise ValueError(path + ' has more than 64 units, which do not fit '
+                         'a uint64 bitmask.')
+    return definition
+
+
+def build_pools(definition, make_trait, make_unit):
+    # make_trait(entry) and make_unit(entry, traits) build each script's
+    # own Trait and Node classes from the set file entries.
+    traits = {}
+    trait_pool = []
+    for entry in definition['traits']:
+        traits[entry['name']] = make_trait(entry)
+        trait_pool.append(traits[entry['name']])
+    unit_pool = [make_unit(entry, [traits[name]
+                                   for name in entry.get('traits', [])])
+                 for entry in definition['units']]
+    return unit_pool, trait_pool
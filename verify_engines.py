@@ -0,0 +1,346 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+from graph_analysis import (Roster, SplitPlanner, build_graph, build_roster,
+                            check_active, get_branches,
+                            get_combinations, get_hybrid, get_joined,
+                            split_partitions, trait_potential, validate,
+                            validate_checkpointed, validate_parallel,
+                            validate_pipelined)
+
+BASELINE = 'engine_baseline.json'
+
+
+def random_definition(units, traits, rng):
+    # A synthetic set file: small trait thresholds so low levels still have
+    # valid comps, and mostly two traits per unit like the real sets.
+    definition = {'traits': [], 'units': []}
+    for j in range(traits):
+        tiers = sorted(rng.sample(range(1, 9), rng.randint(1, 4)))
+        tiers[0] = min(tiers[0], rng.choice([1, 2, 2, 3]))
+        tiers = sorted(set(tiers))
+        definition['traits'].append({'name': 'trait_' + str(j),
+                                     'tiers': tiers})
+    for i in range(units):
+        count = rng.choice([0, 1, 2, 2, 2, 3])
+        definition['units'].append(
+            {'name': 'unit_' + str(i), 'cost': rng.randint(1, 5),
+             'traits': [trait['name'] for trait in
+                        rng.sample(definition['traits'], min(count, traits))]})
+    return definition
+
+
+def load_rosters(args, rng):
+    rosters = [('real', build_roster(), args.real_levels)]
+    for seed in range(args.synthetic):
+        definition = random_definition(args.units, args.traits, rng)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'roster.json')
+            with open(path, 'w') as file:
+                json.dump(definition, file)
+            rosters.append(('synthetic_' + str(seed), build_roster(path),
+                            args.synthetic_levels))
+    return rosters
+
+
+def oracle(level, traits, unit_pool, roster):
+    # Today's brute force: plain combinations through the object validate.
+    comps = validate(get_combinations(level, unit_pool), level, traits)
+    return set(roster.encode(comp) for comp in comps)
+
+
+def iterate_seeded_growth(comp_pool):
+    # The original generator; only the membership tests use sets.
+    results = []
+    seen = set()
+    excluded = set()
+    prev_seed = None
+    for team in comp_pool:
+        neighbors = []
+        current_seed = team[0]
+        if current_seed != prev_seed and prev_seed is not None:
+            excluded.add(prev_seed)
+        for node in team:
+            for neighbor in node.get_neighbors():
+                if neighbor not in team and neighbor not in neighbors:
+                    if neighbor not in excluded:
+                        neighbors.append(neighbor)
+        for neighbor in neighbors:
+            sorted_team = tuple(sorted(team + (neighbor,), key=lambda x:
+                                       (x.cost, x.name)))
+            if sorted_team not in seen:
+                seen.add(sorted_team)
+                results.append(sorted_team)
+        prev_seed = current_seed
+    return list(sorted(results, key=lambda x: (x[0].cost, x[0].name)))
+
+
+def hybrid_candidates(split, unit_pool, trait_pool):
+    # The original hybrid generator, growth order and branches.remove()
+    # while iterating included. Returns the candidate count and the
+    # candidate iterator.
+    branches = {2: [], 3: [], 4: []}
+    grown = [tuple([unit]) for unit in unit_pool]
+    for size in [2, 3, 4]:
+        if max(split) < size:
+            break
+        grown = iterate_seeded_growth(grown)
+        branches[size] = list(grown)
+    for size in [2, 3, 4]:
+        for branch in branches[size]:
+            current, potential = trait_potential(branch, size + 1,
+                                                 trait_pool)
+            if current < size and potential < size + 1:
+                branches[size].remove(branch)
+    pools = [branches[4], branches[3], branches[2],
+             [tuple([unit]) for unit in unit_pool]]
+    counts = [split.count(size) for size in [4, 3, 2, 1]]
+    total = math.prod(math.comb(len(pool), count)
+                      for pool, count in zip(pools, counts))
+    return total, itertools.product(*[itertools.combinations(pool, count)
+                                      for pool, count in zip(pools, counts)])
+
+
+def hybrid_oracle(candidates, level, traits, roster):
+    masks = set()
+    for parts in candidates:
+        team = set(unit for group in parts for branch in group
+                   for unit in branch)
+        if len(team) == level and len(check_active(team)) >= traits:
+            masks.add(roster.encode(team))
+    return masks
+
+
+def connected(mask, graph):
+    reached = mask & -mask
+    frontier = reached
+    while frontier:
+        low = frontier & -frontier
+        frontier ^= low
+        grown = graph.get_neighbor_mask(graph.get_units()[
+            low.bit_length() - 1]) & mask & ~reached
+        reached |= grown
+        frontier |= grown
+    return reached == mask
+
+
+def engines(level, traits, unit_pool, trait_pool, roster, planner, args):
+    # (name, split or None for the full oracle, run) for every engine mode;
+    # each run returns the validated comps as unit bitmasks.
+    def encoded(comps):
+        return set(roster.encode(comp) for comp in comps)
+
+    def checkpointed():
+        with tempfile.TemporaryDirectory() as directory:
+            masks = validate_checkpointed(level, traits, unit_pool, roster,
+                                          directory)
+            return set(masks.tolist())
+
+    def planned():
+        return encoded(planner.run(level, traits))
+
+    modes = [
+        ('combinations', None, lambda: encoded(validate(
+            get_combinations(level, unit_pool, roster=roster), level,
+            traits, roster=roster))),
+        ('search', None, lambda: encoded(roster.search(level, traits))),
+        ('search_no_symmetry', None, lambda: encoded(
+            roster.search(level, traits, symmetry=False))),
+        ('join', None, lambda: encoded(validate(
+            get_joined(level, unit_pool, trait_pool, traits, roster=roster),
+            level, traits, roster=roster, unique=True))),
+        ('checkpointed', None, checkpointed),
+        ('parallel', None, lambda: encoded(validate_parallel(
+            level, traits, unit_pool, trait_pool, roster,
+            workers=args.workers))),
+        ('pipeline', None, lambda: encoded(validate_pipelined(
+            get_combinations(level, unit_pool, roster=roster), level,
+            traits, roster, workers=args.workers))),
+        ('branches', 'connected', lambda: encoded(validate(
+            get_branches(level, unit_pool), level, traits, roster=roster)))]
+    for split in split_partitions(level):
+        if split == [1] * level:
+            continue
+        modes.append(('hybrid_' + '_'.join(map(str, split)), split,
+                      lambda split=split: encoded(validate(
+                          get_hybrid(split, unit_pool, trait_pool,
+                                     roster=roster, traits=traits),
+                          level, traits, roster=roster, unique=True))))
+        modes.append(('parallel_hybrid_' + '_'.join(map(str, split)), split,
+                      lambda split=split: encoded(validate_parallel(
+                          level, traits, unit_pool, trait_pool, roster,
+                          split=split, workers=args.workers))))
+    modes.append(('planner', None, planned))
+    return modes
+
+
+def measure(run, trials):
+    best = math.inf
+    for _ in range(trials):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start_time = time.time()
+            masks = run()
+            best = min(best, time.time() - start_time)
+    return best, masks
+
+
+def verify_level(label, level, unit_pool, trait_pool, roster, graph, args):
+    # Rates are level-unit sets covered per second, so engines and rosters
+    # of different sizes share one scale.
+    traits = max(0, level - args.slack)
+    covered = math.comb(len(unit_pool), level)
+    results = {}
+    failures = []
+    planner = SplitPlanner(unit_pool, trait_pool, roster, sample_seconds=0.05)
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = {None: oracle(level, traits, unit_pool, roster)}
+        count = roster.count_valid(level, traits)
+        # Estimate the plans here so the planner run times only the engine.
+        planner.choose(level, traits)
+    expected['connected'] = set(mask for mask in expected[None]
+                                if connected(mask, graph))
+    if count != len(expected[None]):
+        failures.append(label + ' level ' + str(level) + ' count_valid: ' +
+                        str(count) + ' instead of ' +
+                        str(len(expected[None])))
+    for name, target, run in engines(level, traits, unit_pool, trait_pool,
+                                     roster, planner, args):
+        if args.engines and name not in args.engines:
+            continue
+        if isinstance(target, list):
+            target = tuple(target)
+            if target not in expected:
+                total, candidates = hybrid_candidates(list(target),
+                                                      unit_pool, trait_pool)
+                if total > args.max_oracle:
+                    print('    ' + name + ': skipped, oracle would check ' +
+                          str(total) + ' candidates')
+                    continue
+                expected[target] = hybrid_oracle(candidates, level, traits,
+                                                 roster)
+        key = label + '/' + str(level) + '/' + name
+        try:
+            best, masks = measure(run, args.trials)
+        except ValueError as error:
+            print('    ' + name + ': skipped, ' + str(error))
+            continue
+        results[key] = {'seconds': best,
+                        'rate': covered / max(best, 1e-9)}
+        missing = len(expected[target] - masks)
+        extra = len(masks - expected[target])
+        status = 'ok'
+        if missing or extra:
+            status = 'DIVERGED'
+            failures.append(key + ': ' + str(missing) + ' missing, ' +
+                            str(extra) + ' extra of ' +
+                            str(len(expected[target])))
+        print('    ' + name + ': ' + str(len(masks)) + ' comps in ' +
+              str(best) + ' seconds, ' + status)
+    return results, failures
+
+
+def family(key):
+    # hybrid_2_1 and hybrid_3 are the same engine on different splits.
+    return '_'.join(part for part in key.split('/')[2].split('_')
+                    if not part.isdigit())
+
+
+def check_regressions(results, baseline, threshold, min_seconds, min_runs):
+    # Engines are compared by the geometric mean of their rate ratios over
+    # every roster, level and split: a slower hot path shows up in all of
+    # them, where a single run on a busy machine can be off by 2x. Families
+    # with fewer than min_runs timed runs are reported but not gated.
+    logs = {}
+    for key, result in results.items():
+        if key in baseline and result['seconds'] >= min_seconds:
+            logs.setdefault(family(key), []).append(
+                math.log(result['rate'] / baseline[key]['rate']))
+    failures = []
+    for name, ratios in sorted(logs.items()):
+        ratio = math.exp(sum(ratios) / len(ratios))
+        gated = len(ratios) >= min_runs
+        print(name + ': ' + str(round(ratio, 2)) + ' times the baseline '
+              'rate over ' + str(len(ratios)) + ' runs' +
+              ('' if gated else ', too few to gate'))
+        if gated and ratio < 1 - threshold:
+            failures.append(name + ' runs at ' + str(round(ratio, 2)) +
+                            ' times the baseline rate')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check every engine mode against the brute force '
+                    'get_combinations + validate oracle on the real roster '
+                    'and synthetic ones, and gate throughput on a stored '
+                    'baseline.')
+    parser.add_argument('--real-levels', type=int, default=4)
+    parser.add_argument('--synthetic', type=int, default=3,
+                        help='number of random rosters')
+    parser.add_argument('--units', type=int, default=16)
+    parser.add_argument('--traits', type=int, default=8)
+    parser.add_argument('--synthetic-levels', type=int, default=6)
+    parser.add_argument('--slack', type=int, default=0,
+                        help='validate level L with L - slack traits')
+    parser.add_argument('--engines', nargs='*', default=[],
+                        help='only run these engine modes')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--trials', type=int, default=3)
+    parser.add_argument('--max-oracle', type=int, default=2000000,
+                        help='skip hybrid modes whose oracle would check '
+                             'more candidates than this')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.3,
+                        help='allowed drop in mean rate per engine against '
+                             'the baseline')
+    parser.add_argument('--min-seconds', type=float, default=0.1,
+                        help='runs faster than this are too noisy to gate')
+    parser.add_argument('--min-runs', type=int, default=3,
+                        help='engines with fewer timed runs than this are '
+                             'not gated')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = {}
+    failures = []
+    for label, (unit_pool, trait_pool), levels in load_rosters(args, rng):
+        graph = build_graph(unit_pool)
+        roster = Roster(unit_pool, trait_pool)
+        for level in range(1, levels + 1):
+            print(label + ' level ' + str(level) + ':')
+            found, diverged = verify_level(label, level, unit_pool,
+                                           trait_pool, roster, graph, args)
+            results.update(found)
+            failures.extend(diverged)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+        print('Wrote ' + str(len(results)) + ' rates to ' + args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            failures.extend(check_regressions(results, json.load(file),
+                                              args.threshold,
+                                              args.min_seconds,
+                                              args.min_runs))
+
+    for failure in failures:
+        print('FAIL ' + failure)
+    print(str(len(results)) + ' engine runs, ' + str(len(failures)) +
+          ' failures')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()